@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+Compare the persistent-circuit and rebuild paths of OpenDSSExperiment.
+
+Runs the Iowa feeder over the benchmark window once rebuilding the circuit every
+step and once on a persistent circuit with carry_taps=False, and reports the
+largest difference in node voltage, regulator tap and element loading between the
+two, and the steps where the set of overloaded elements differs. Exits with status
+1 if the voltages or loadings differ by more than the tolerance, or any tap or
+overload differs.
+
+Rebuilding stays the default of OpenDSSExperiment: the persistent path resets the
+loads, taps and controls each step but keeps the rest of the solver state, so it
+is only expected to match to within solver tolerance, not exactly.
+
+Usage:
+    python benchmarks/compare_persistent.py --days 1 --tolerance 1e-9
+"""
+import argparse
+import sys
+
+from run_benchmarks import DSS_START, PERIOD, _setup
+
+
+def compare_paths(days=1, reg_control=True):
+    """Run both paths over days of the benchmark window.
+
+    Returns:
+        Dict[str, float]: max_voltage_diff [pu], max_tap_diff, tap_mismatches
+            (steps where any regulator tap differs), max_loading_diff [% of normal
+            rating] and overload_mismatches (steps where the set of elements above
+            their normal rating differs).
+    """
+    _setup()
+    import numpy as np
+
+    # noinspection PyUnresolvedReferences
+    from opendss_experiment import OpenDSSExperiment
+
+    results = {}
+    for persistent in (False, True):
+        experiment = OpenDSSExperiment(
+            DSS_START,
+            days * 24 * 60,
+            PERIOD,
+            reg_control=reg_control,
+            persistent_circuit=persistent,
+        )
+        experiment.run(detailed_metrics=["capacity"])
+        results[persistent] = experiment.results
+    rebuild, persistent = results[False], results[True]
+    taps = np.abs(rebuild.taps - persistent.taps)
+    loading = np.abs(rebuild.capacity[1] - persistent.capacity[1])
+    overloads = (rebuild.capacity[1] > 100) != (persistent.capacity[1] > 100)
+    return {
+        "max_voltage_diff": float(
+            np.nanmax(np.abs(rebuild.voltages - persistent.voltages))
+        ),
+        "max_tap_diff": float(np.nanmax(taps, initial=0)),
+        "tap_mismatches": int(np.any(taps > 0, axis=1).sum()),
+        "max_loading_diff": float(np.nanmax(loading, initial=0)),
+        "overload_mismatches": int(np.any(overloads, axis=1).sum()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument("--no-reg-control", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-9,
+        help="Largest allowed node voltage [pu] and loading [%%] difference.",
+    )
+    args = parser.parse_args()
+
+    diff = compare_paths(args.days, not args.no_reg_control)
+    for name, value in diff.items():
+        print(f"{name:<20}{value:>14.3g}")
+    if (
+        max(diff["max_voltage_diff"], diff["max_loading_diff"]) > args.tolerance
+        or diff["tap_mismatches"]
+        or diff["overload_mismatches"]
+    ):
+        print("The persistent circuit differs from the rebuild path.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
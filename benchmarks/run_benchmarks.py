@@ -0,0 +1,325 @@
+# coding=utf-8
+"""
+Reproducible performance benchmarks for the ACN-Sim, OpenDSS and composite
+experiments of the grid impacts example.
+
+All inputs are local: sessions come from the bundled Caltech event dump of the
+algorithm comparison example (or from the JPL GMM of the infrastructure example),
+and the feeder is the Iowa test feeder. The Iowa nodal load csv files must have
+been downloaded once (see the 3.2 notebook). Algorithms which need MOSEK are not
+included.
+
+Each benchmark runs in a fresh process, so peak memory is measured per benchmark.
+
+Timings depend on the machine, so no baseline is shipped. Record one on the machine
+that will run the comparisons (by default in benchmarks/baseline.json, which is not
+tracked), then compare later runs against it.
+
+Usage:
+    python benchmarks/run_benchmarks.py                       # run and print
+    python benchmarks/run_benchmarks.py --save-baseline       # record baseline
+    python benchmarks/run_benchmarks.py --baseline            # compare
+    python benchmarks/run_benchmarks.py --baseline b.json     # compare to b.json
+    python benchmarks/run_benchmarks.py --only dss --repeat 3
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = os.path.join(ROOT, "examples")
+GRID_EXAMPLE = os.path.join(
+    EXAMPLES, "3-Grid-Impacts", "3.2-Iowa-Feeder-with-EV-and-Solar-OpenDSS"
+)
+EVENTS_DIR = os.path.join(
+    EXAMPLES,
+    "2-Algorithm-Comparison",
+    "2.1-Comparing-Algorithms-with-Constrained-Infrastructure",
+    "events",
+)
+GMM_PATH = os.path.join(
+    EXAMPLES,
+    "1-Infrastructure-Evaluation",
+    "1.2-Comparing-Infrastructure-Designs",
+    "data",
+    "jpl_weekday_40.pkl",
+)
+
+# Start of the benchmark window in the bundled Caltech event dump (a Monday).
+ACN_START = datetime(2019, 3, 4)
+# Start of the benchmark window in the Iowa nodal load data.
+DSS_START = datetime(2017, 9, 5)
+PERIOD = 5  # minutes
+ACN_ALGORITHMS = ("unctrl", "llf", "load_flattening_ECOS")
+# Days of external load past the end of the window, covering the horizon of the
+# optimization based algorithms.
+EXTERNAL_LOAD_PAD_DAYS = 2
+# Baseline read and written when --baseline / --save-baseline are given no path.
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+
+def _setup():
+    """ Make the grid impacts modules importable and their data paths valid. """
+    os.chdir(GRID_EXAMPLE)
+    sys.path.insert(0, os.path.join(GRID_EXAMPLE, "src"))
+
+
+def _acn_config(alg_name, days, event_store, sim_dir):
+    """ ACNExperiment arguments for the benchmark window. """
+    import numpy as np
+
+    # Load flattening reads external_load over its whole optimization horizon, which
+    # runs past the end of the window, so pad it as the 3.2 notebook does (2 days).
+    steps = (days + EXTERNAL_LOAD_PAD_DAYS) * 24 * 60 // PERIOD
+    return {
+        "site": "caltech",
+        "start": ACN_START,
+        "end": ACN_START + timedelta(days=days),
+        "alg_name": alg_name,
+        "tariff_name": "sce_tou_ev_4_march_2019",
+        "external_load": np.zeros(steps),
+        "sim_dir": sim_dir,
+        "storage": "arrays",
+        "event_store": event_store,
+    }
+
+
+def bench_acn(alg_name, days):
+    """ ACNExperiment.run for one algorithm, from the local event store. """
+    # noinspection PyUnresolvedReferences
+    from acn_experiment import ACNExperiment
+
+    # noinspection PyUnresolvedReferences
+    from event_store import EventStore
+
+    store = EventStore.from_directory(EVENTS_DIR)
+    with tempfile.TemporaryDirectory() as sim_dir:
+        experiment = ACNExperiment(**_acn_config(alg_name, days, store, sim_dir))
+        start = time.perf_counter()
+        experiment.run()
+        elapsed = time.perf_counter() - start
+    return elapsed, days * 24 * 60 // PERIOD
+
+
+def bench_acn_gmm(sessions_per_day, days, seed=0):
+    """ Uncontrolled ACN-Sim run with sessions drawn from the JPL GMM. """
+    import pickle
+
+    import numpy as np
+    import sklearn.mixture
+    from acnportal import acnsim, algorithms
+    from acnportal.acnsim.events import GaussianMixtureEvents
+
+    class Unpickler(pickle.Unpickler):
+        def find_class(self, module, name):
+            if name in ("sklearn.mixture.gaussian_mixture", "GaussianMixture"):
+                return sklearn.mixture.GaussianMixture
+            return super().find_class(module, name)
+
+    with open(GMM_PATH, "rb") as f:
+        gmm = Unpickler(f).load()
+    np.random.seed(seed)
+    generator = GaussianMixtureEvents(pretrained_model=gmm, duration_min=0.08334)
+    events = generator.generate_events([sessions_per_day] * days, PERIOD, 208, 6.6)
+    network = acnsim.sites.caltech_acn(basic_evse=True, voltage=208)
+    sim = acnsim.Simulator(
+        network,
+        algorithms.UncontrolledCharging(),
+        events,
+        ACN_START,
+        period=PERIOD,
+        verbose=False,
+    )
+    start = time.perf_counter()
+    sim.run()
+    return time.perf_counter() - start, sim.charging_rates.shape[1]
+
+
+def bench_dss(days, detailed_metrics, cached=False):
+    """ OpenDSSExperiment.run over the Iowa feeder. """
+    # noinspection PyUnresolvedReferences
+    from opendss_experiment import OpenDSSExperiment
+
+    # noinspection PyUnresolvedReferences
+    from solution_cache import SolutionCache
+
+    experiment = OpenDSSExperiment(
+        DSS_START,
+        days * 24 * 60,
+        PERIOD,
+        solution_cache=SolutionCache() if cached else None,
+    )
+    start = time.perf_counter()
+    experiment.run(detailed_metrics=detailed_metrics)
+    return time.perf_counter() - start, experiment.results.steps
+
+
+def bench_composite(days):
+    """ ACN-Sim run, EV load injection and feeder run of a composite experiment. """
+    # noinspection PyUnresolvedReferences
+    from composite_experiment import ACNOpenDSSCompositeExperiment
+
+    # noinspection PyUnresolvedReferences
+    from event_store import EventStore
+
+    store = EventStore.from_directory(EVENTS_DIR)
+    with tempfile.TemporaryDirectory() as sim_dir:
+        dss_config = {"start": DSS_START, "horizon": days * 24 * 60, "period": PERIOD}
+        acn_configs = {"2053": _acn_config("unctrl", days, store, sim_dir)}
+        composite = ACNOpenDSSCompositeExperiment(dss_config, acn_configs)
+        start = time.perf_counter()
+        composite.run_acn()
+        composite.add_acn_loads()
+        composite.run_dss(detailed_metrics=False)
+        elapsed = time.perf_counter() - start
+    return elapsed, composite.open_dss_experiment.results.steps
+
+
+def benchmarks(days, horizons):
+    """ Name, function and arguments of every benchmark. """
+    cases = [(f"acn_{alg}", bench_acn, (alg, days)) for alg in ACN_ALGORITHMS]
+    cases.append(("acn_gmm_unctrl", bench_acn_gmm, (100, days)))
+    cases.append(("dss_basic", bench_dss, (days, False)))
+    cases.append(("dss_detailed", bench_dss, (days, True)))
+    cases.append(("dss_cached", bench_dss, (days, False, True)))
+    cases.extend((f"composite_{h}d", bench_composite, (h,)) for h in horizons)
+    return cases
+
+
+def _run_in_process(function, args):
+    """ Run a benchmark in this (fresh) process and measure its peak memory. """
+    _setup()
+    elapsed, steps = function(*args)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    peak_mb = peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+    return {"elapsed": elapsed, "steps": steps, "peak_mb": peak_mb}
+
+
+def run(names=None, days=1, horizons=(1, 3, 7), repeat=1):
+    """Run the benchmarks.
+
+    Args:
+        names (List[str]): Substrings selecting which benchmarks to run. Defaults
+            to all.
+        days (int): Simulated days for the ACN-Sim and OpenDSS benchmarks.
+        horizons (Iterable[int]): Simulated days of each composite benchmark.
+        repeat (int): Runs of each benchmark. The fastest is reported.
+
+    Returns:
+        Dict[str, Dict]: elapsed [s], steps, steps_per_sec and peak_mb of each
+            benchmark, or error if it failed.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name, function, args in benchmarks(days, horizons):
+        if names and not any(n in name for n in names):
+            continue
+        runs = []
+        for _ in range(repeat):
+            try:
+                with context.Pool(1) as pool:
+                    runs.append(pool.apply(_run_in_process, (function, args)))
+            except Exception as e:
+                results[name] = {"error": f"{type(e).__name__}: {e}"}
+                break
+        else:
+            best = min(runs, key=lambda r: r["elapsed"])
+            best["steps_per_sec"] = best["steps"] / best["elapsed"]
+            best["peak_mb"] = max(r["peak_mb"] for r in runs)
+            results[name] = best
+        print(name, results[name], flush=True)
+    return results
+
+
+def machine():
+    """ Description of the machine and interpreter the benchmarks ran on. """
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print each benchmark relative to the baseline.
+
+    Returns:
+        List[str]: Benchmarks whose throughput fell, or whose peak memory grew, by
+            more than tolerance (a fraction).
+    """
+    regressions = []
+    header = ("benchmark", "steps/s", "vs base", "peak MB", "vs base")
+    print(f"{header[0]:<28}" + "".join(f"{h:>10}" for h in header[1:]))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if "error" in result or base is None or "error" in base:
+            print(f"{name:<28}{result.get('error', 'no baseline')}")
+            continue
+        speed = result["steps_per_sec"] / base["steps_per_sec"]
+        memory = result["peak_mb"] / base["peak_mb"]
+        print(
+            f"{name:<28}{result['steps_per_sec']:>10.1f}{speed:>10.2f}"
+            f"{result['peak_mb']:>10.0f}{memory:>10.2f}"
+        )
+        if speed < 1 - tolerance or memory > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--only", nargs="*", help="Substrings of benchmarks to run.")
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument("--horizons", type=int, nargs="*", default=[1, 3, 7])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--save-baseline",
+        nargs="?",
+        const=DEFAULT_BASELINE,
+        help=f"Write the results to this file (default {DEFAULT_BASELINE}).",
+    )
+    parser.add_argument(
+        "--baseline",
+        nargs="?",
+        const=DEFAULT_BASELINE,
+        help=f"Compare the results to this file (default {DEFAULT_BASELINE}).",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed fractional slowdown or memory growth against the baseline.",
+    )
+    args = parser.parse_args()
+    if args.baseline and not os.path.exists(args.baseline):
+        parser.error(
+            f"No baseline at {args.baseline}. Record one on this machine first with "
+            f"--save-baseline {args.baseline}."
+        )
+
+    results = run(args.only, args.days, args.horizons, args.repeat)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"machine": machine(), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["machine"] != machine():
+            print("Warning: the baseline was recorded on a different machine.")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# coding=utf-8
+"""
+Monte Carlo evaluation of infrastructure designs with events drawn from a GMM.
+"""
+import multiprocessing
+import os
+import pickle
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import adacharge
+import numpy as np
+import pandas as pd
+import pytz
+import sklearn.mixture
+from acnportal import acnsim
+from acnportal.acnsim.events import GaussianMixtureEvents
+from acnportal.signals.tariffs.tou_tariff import TimeOfUseTariff
+from scipy import stats
+from tqdm import tqdm
+
+PERIOD = 5  # minutes
+VOLTAGE = 208  # volts
+DEFAULT_BATTERY_POWER = 6.6  # kW
+TIMEZONE = "America/Los_Angeles"
+START = datetime(2019, 6, 1)
+TARIFF = "sce_tou_ev_4_march_2019"
+
+# Metrics reported for every replica, in table order.
+METRICS = (
+    "proportion_of_energy_delivered",
+    "energy_delivered",
+    "num_swaps",
+    "num_never_charged",
+    "energy_cost",
+    "demand_charge",
+    "total_cost",
+    "$/kWh",
+)
+# Columns of the per-replica results table.
+COLUMNS = ("config", "replica", "seed", "error", *METRICS)
+
+# GMM of the worker process, set once by _init_worker.
+_gmm = None
+
+
+# The custom unpickler is due to SO user Pankaj Saini's answer:
+# https://stackoverflow.com/a/51397373/3896008
+class CustomUnpicklerJPLdata(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == "sklearn.mixture.gaussian_mixture":
+            return sklearn.mixture.GaussianMixture
+        if name == "GaussianMixture":
+            return sklearn.mixture.GaussianMixture
+        return super().find_class(module, name)
+
+
+def load_gmm(path: str = "data/jpl_weekday_40.pkl"):
+    """ Load a pretrained GaussianMixture of session arrivals and durations. """
+    with open(path, "rb") as f:
+        return CustomUnpicklerJPLdata(f).load()
+
+
+def weekday_sessions(sessions_per_day: int) -> List[int]:
+    """Sessions to draw on each of 30 days starting on a Saturday, with no sessions
+    on weekends."""
+    week = [0] * 2 + [sessions_per_day] * 5
+    return week * 4 + [0] * 2
+
+
+def days_remaining_scale_demand_charge(
+    rates, infrastructure, interface, baseline_peak=0, **kwargs
+):
+    """ Demand charge scaled by the number of days left in the billing period. """
+    day_index = interface.current_time // ((60 / interface.period) * 24)
+    days_in_month = 30
+    day_index = min(day_index, days_in_month - 1)
+    scale = 1 / (days_in_month - day_index)
+    dc = adacharge.demand_charge(
+        rates, infrastructure, interface, baseline_peak, **kwargs
+    )
+    return scale * dc
+
+
+def draw_events(gmm, sessions_per_day: int, seed: int):
+    """Draw 30 days of sessions from gmm.
+
+    The draw depends only on seed, so a replica can be reproduced in any process.
+    gmm is given one RandomState for the whole replica; an int random_state would
+    be re-seeded at every sample call, giving every day the same sessions. Invalid
+    sessions drawn from the distribution are dropped.
+    """
+    gmm.random_state = np.random.RandomState(seed)
+    gen = GaussianMixtureEvents(pretrained_model=gmm, duration_min=0.08334)
+    return gen.generate_events(
+        weekday_sessions(sessions_per_day), PERIOD, VOLTAGE, DEFAULT_BATTERY_POWER
+    )
+
+
+def simulate(network, algorithm, events) -> Dict[str, float]:
+    """Run one simulation of the study month and compute its metrics.
+
+    network and algorithm are used (and modified) in place, so pass copies if they
+    are needed again.
+    """
+    start = pytz.timezone(TIMEZONE).localize(START)
+    signals = {"tariff": TimeOfUseTariff(TARIFF)}
+    sim = acnsim.Simulator(
+        network, algorithm, events, start, period=PERIOD, verbose=False, signals=signals
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        sim.run()
+
+    r = {
+        "proportion_of_energy_delivered": acnsim.proportion_of_energy_delivered(sim),
+        "energy_delivered": sum(ev.energy_delivered for ev in sim.ev_history.values()),
+        "num_swaps": network.swaps,
+        "num_never_charged": network.never_charged,
+        "energy_cost": acnsim.energy_cost(sim),
+        "demand_charge": acnsim.demand_charge(sim),
+    }
+    r["total_cost"] = r["energy_cost"] + r["demand_charge"]
+    r["$/kWh"] = r["total_cost"] / r["energy_delivered"]
+    return r
+
+
+def sessions_by_day(events) -> Dict[int, List[Tuple]]:
+    """ Arrival (within the day), departure and energy of each session, by day. """
+    steps_per_day = 24 * 60 // PERIOD
+    days = {}
+    for _, event in events._queue:
+        ev = getattr(event, "ev", None)
+        if ev is None:
+            continue
+        day, arrival = divmod(ev.arrival, steps_per_day)
+        days.setdefault(day, []).append(
+            (arrival, ev.departure - day * steps_per_day, ev.requested_energy)
+        )
+    return {day: sorted(sessions) for day, sessions in days.items()}
+
+
+def check_draws(gmm, sessions_per_day: int, seed: int):
+    """Check that draw_events gives different sessions on different weekdays of a
+    replica and the same sessions for the same seed.
+
+    Raises:
+        ValueError: If either property does not hold.
+    """
+    first = sessions_by_day(draw_events(gmm, sessions_per_day, seed))
+    again = sessions_by_day(draw_events(gmm, sessions_per_day, seed))
+    if first != again:
+        raise ValueError(f"Draws with seed {seed} are not reproducible.")
+    weekdays = [day for day, n in enumerate(weekday_sessions(1)) if n]
+    drawn = [first[day] for day in weekdays if first.get(day)]
+    if len(drawn) > 1 and all(sessions == drawn[0] for sessions in drawn[1:]):
+        raise ValueError(f"Every weekday drawn with seed {seed} has the same sessions.")
+
+
+def replica_seeds(seed: int, replicas: int) -> List[int]:
+    """Independent seeds for each replica, derived from one base seed.
+
+    Replica i of every configuration shares a seed, so designs are compared on the
+    same draws (common random numbers).
+    """
+    states = np.random.SeedSequence(seed).spawn(replicas)
+    return [int(s.generate_state(1)[0]) for s in states]
+
+
+def _init_worker(gmm):
+    """ Keep the GMM for every replica run in this worker. """
+    global _gmm
+    _gmm = gmm
+
+
+def _run_replica(network, algorithm, sessions_per_day: int, seed: int):
+    """ Draw events and run one replica in a worker process. """
+    events = draw_events(_gmm, sessions_per_day, seed)
+    return simulate(network, algorithm, events)
+
+
+def _append_row(path: str, row: Dict):
+    """ Append one replica row to a csv file, writing the header if it is new. """
+    frame = pd.DataFrame([row], columns=COLUMNS)
+    frame.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+def run_monte_carlo(
+    configs: Dict[str, Tuple],
+    replicas: int,
+    seed: int = 0,
+    workers: Optional[int] = None,
+    gmm_path: str = "data/jpl_weekday_40.pkl",
+    results_path: Optional[str] = None,
+) -> pd.DataFrame:
+    """Run independent replicas of each configuration on a process pool.
+
+    The GMM is loaded once and sent once to each worker. Networks and algorithms are
+    sent with each replica, so every replica starts from a fresh copy without any
+    deepcopy in the parent. Algorithms must be picklable, so objective functions have
+    to be importable (e.g. days_remaining_scale_demand_charge), not defined in the
+    notebook. Before the pool starts, check_draws verifies on the first seed that
+    draws differ between days and are reproducible.
+
+    Args:
+        configs (Dict[str, Tuple[ChargingNetwork, BaseAlgorithm, int]]): Network,
+            algorithm and sessions per weekday of each configuration, by name.
+        replicas (int): Number of replicas of each configuration.
+        seed (int): Base seed from which the seed of each replica is derived.
+        workers (int): Number of worker processes. Defaults to the number of cores.
+        gmm_path (str): Path of the pickled GMM.
+        results_path (str): If given, each replica's row is appended to this csv
+            file as soon as it finishes. Its directory is created if needed. A
+            failed append is reported as a warning and does not stop the run.
+
+    Returns:
+        pd.DataFrame: One row per replica, with columns config, replica, seed,
+            error and each of METRICS. Failed replicas have an error and NaN
+            metrics.
+    """
+    gmm = load_gmm(gmm_path)
+    seeds = replica_seeds(seed, replicas)
+    if configs and seeds:
+        sessions_per_day = max(spd for _, _, spd in configs.values())
+        check_draws(gmm, sessions_per_day, seeds[0])
+    rows = []
+    if results_path is not None:
+        os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    # Spawn rather than fork, so workers start with a fresh BLAS thread pool.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count() or 1,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(gmm,),
+    ) as pool:
+        futures = {}
+        for name, (network, algorithm, sessions_per_day) in configs.items():
+            for i, replica_seed in enumerate(seeds):
+                future = pool.submit(
+                    _run_replica, network, algorithm, sessions_per_day, replica_seed
+                )
+                futures[future] = (name, i, replica_seed)
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            name, i, replica_seed = futures[future]
+            row = {"config": name, "replica": i, "seed": replica_seed, "error": None}
+            try:
+                row.update(future.result())
+            except Exception:
+                row["error"] = traceback.format_exc()
+            rows.append(row)
+            if results_path is not None:
+                try:
+                    _append_row(results_path, row)
+                except OSError as e:
+                    warnings.warn(f"Could not append replica to {results_path}: {e}")
+    results = pd.DataFrame(rows, columns=COLUMNS)
+    return results.sort_values(["config", "replica"], ignore_index=True)
+
+
+def summarize(results: pd.DataFrame, confidence: float = 0.95) -> pd.DataFrame:
+    """Mean of each metric of each configuration with a confidence interval.
+
+    Intervals use the t distribution over the successful replicas, so they are NaN
+    for configurations with fewer than two.
+
+    Args:
+        results (pd.DataFrame): Output of run_monte_carlo.
+        confidence (float): Confidence level of the intervals.
+
+    Returns:
+        pd.DataFrame: Index (config, metric), columns n, mean, std, ci_low and
+            ci_high.
+    """
+    ok = results[results["error"].isna()]
+    records = []
+    for name, group in ok.groupby("config", sort=False):
+        for metric in METRICS:
+            values = group[metric].astype(float).dropna()
+            n = len(values)
+            mean = values.mean()
+            std = values.std(ddof=1) if n > 1 else np.nan
+            half = np.nan
+            if n > 1:
+                half = stats.t.ppf((1 + confidence) / 2, n - 1) * std / np.sqrt(n)
+            records.append(
+                {
+                    "config": name,
+                    "metric": metric,
+                    "n": n,
+                    "mean": mean,
+                    "std": std,
+                    "ci_low": mean - half,
+                    "ci_high": mean + half,
+                }
+            )
+    return pd.DataFrame(records).set_index(["config", "metric"])
@@ -0,0 +1,222 @@
+# coding=utf-8
+"""
+Append-only store of the metrics and solver statistics of finished experiments.
+"""
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOG_NAME = "log.jsonl"
+SEGMENT_DIR = "segments"
+
+
+def config_key(config: Dict) -> str:
+    """ Stable digest of a JSON-serializable configuration. """
+    normalized = json.dumps(config, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def to_columns(records: List[Dict]) -> Dict[str, np.ndarray]:
+    """Turn a list of records (e.g. solve_stats) into one array per field.
+
+    Fields which are not numeric or boolean are stored as strings, so the arrays
+    can be saved and loaded without pickle.
+    """
+    columns = {}
+    for name, column in pd.DataFrame(records).items():
+        if column.dtype == object:
+            column = column.astype(str)
+        columns[str(name)] = column.to_numpy()
+    return columns
+
+
+class ResultSink:
+    """Streams the results of each experiment to disk as soon as it finishes.
+
+    Each experiment is written as one segment, an .npz file holding its solve
+    statistics and any other arrays column by column, followed by one line in an
+    append-only log with its configuration and scalar metrics. The log line is
+    written last, so an experiment is complete exactly when its line is present:
+    a crash mid-write leaves at most an orphaned segment (overwritten on retry) or
+    a torn last line (ignored), and done() tells a resumed sweep what to skip.
+
+    Metrics queries read only the log, and solve statistics queries only the
+    columns asked for, so no simulation is ever rebuilt. The log is locked while
+    appending, so several processes may write to the same sink.
+
+    Args:
+        root (str): Directory of the sink. Created if it does not exist.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._records = {}
+        self._offset = 0
+        os.makedirs(os.path.join(root, SEGMENT_DIR), exist_ok=True)
+
+    @property
+    def log_path(self):
+        return os.path.join(self.root, LOG_NAME)
+
+    def segment_path(self, key: str) -> str:
+        return os.path.join(self.root, SEGMENT_DIR, f"{key}.npz")
+
+    @contextmanager
+    def _locked(self):
+        """ Exclusive access to the log across processes. """
+        with open(os.path.join(self.root, ".lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def refresh(self) -> Dict[str, Dict]:
+        """Read log lines appended since the last call (also by other processes).
+
+        Returns:
+            Dict[str, Dict]: Record of each complete experiment, by key.
+        """
+        if not os.path.exists(self.log_path):
+            return self._records
+        with open(self.log_path, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn write of a crashed process: not complete, and the next
+                    # append starts on a new line.
+                    break
+                self._offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._records[record["key"]] = record
+        return self._records
+
+    def done(self, config: Dict) -> bool:
+        """ True if the results of config have been written. """
+        return config_key(config) in self.refresh()
+
+    def write(
+        self,
+        config: Dict,
+        metrics: Dict,
+        solve_stats: Optional[List[Dict]] = None,
+        arrays: Optional[Dict[str, np.ndarray]] = None,
+    ):
+        """Write the results of one finished experiment.
+
+        Args:
+            config (Dict): JSON-serializable configuration of the experiment.
+            metrics (Dict): Scalar metrics of the experiment.
+            solve_stats (List[Dict]): Per-call statistics of the scheduler, e.g.
+                AdaptiveSchedulingAlgorithm.solve_stats.
+            arrays (Dict[str, np.ndarray]): Other arrays to keep, e.g. aggregate
+                power.
+        """
+        key = config_key(config)
+        segment = None
+        if solve_stats or arrays:
+            columns = {}
+            if solve_stats:
+                columns.update(
+                    {f"solve_stats/{k}": v for k, v in to_columns(solve_stats).items()}
+                )
+            for name, array in (arrays or {}).items():
+                columns[f"arrays/{name}"] = np.asarray(array)
+            path = self.segment_path(key)
+            tmp_path = f"{path[:-len('.npz')]}.tmp.npz"
+            np.savez(tmp_path, **columns)
+            os.replace(tmp_path, path)
+            segment = os.path.basename(path)
+        record = {
+            "key": key,
+            "config": config,
+            "metrics": metrics,
+            "segment": segment,
+            "time": time.time(),
+        }
+        line = json.dumps(record, default=float) + "\n"
+        with self._locked():
+            with open(self.log_path, "ab") as f:
+                if f.tell() > 0:
+                    with open(self.log_path, "rb") as r:
+                        r.seek(-1, os.SEEK_END)
+                        if r.read(1) != b"\n":
+                            f.write(b"\n")
+                f.write(line.encode())
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get(self, config: Dict) -> Optional[Dict]:
+        """ Metrics of config, or None if its results have not been written. """
+        record = self.refresh().get(config_key(config))
+        return None if record is None else record["metrics"]
+
+    def metrics(self) -> pd.DataFrame:
+        """ Configuration fields and metrics of each complete experiment (rows). """
+        rows = [
+            {**record["config"], **record["metrics"]}
+            for record in self.refresh().values()
+        ]
+        return pd.DataFrame(rows)
+
+    def _segment(self, config: Dict):
+        record = self.refresh().get(config_key(config))
+        if record is None or record["segment"] is None:
+            return None
+        return np.load(os.path.join(self.root, SEGMENT_DIR, record["segment"]))
+
+    def solve_stats(
+        self, configs: Optional[Iterable[Dict]] = None, columns=None
+    ) -> pd.DataFrame:
+        """Solve statistics of some or all complete experiments.
+
+        Args:
+            configs (Iterable[Dict]): Configurations to read. Defaults to all.
+            columns (List[str]): Fields to read. Defaults to all.
+
+        Returns:
+            pd.DataFrame: One row per scheduler call, with the configuration fields
+                of its experiment as extra columns.
+        """
+        if configs is None:
+            configs = [record["config"] for record in self.refresh().values()]
+        frames = []
+        for config in configs:
+            segment = self._segment(config)
+            if segment is None:
+                continue
+            with segment:
+                names = [n for n in segment.files if n.startswith("solve_stats/")]
+                if columns is not None:
+                    names = [n for n in names if n.split("/", 1)[1] in columns]
+                frame = pd.DataFrame({n.split("/", 1)[1]: segment[n] for n in names})
+            for field, value in config.items():
+                frame[field] = value
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def arrays(self, config: Dict) -> Dict[str, np.ndarray]:
+        """ Arrays written with the results of config. """
+        segment = self._segment(config)
+        if segment is None:
+            return {}
+        with segment:
+            return {
+                n.split("/", 1)[1]: segment[n]
+                for n in segment.files
+                if n.startswith("arrays/")
+            }
@@ -0,0 +1,158 @@
+# coding=utf-8
+"""
+Time-series power flows on a single pandapower network.
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+import pandapower as pp
+from tqdm import tqdm
+
+
+def recycle_options():
+    """runpp recycle options which keep the admittance matrix and internal case
+    between solves and only update the loads, for the installed pandapower."""
+    major, minor = (int(v) for v in pp.__version__.split(".")[:2])
+    if (major, minor) < (2, 2):
+        return {"_is_elements": True, "ppc": True, "Ybus": True}
+    return {"bus_pq": True, "trafo": False, "gen": False}
+
+
+class PowerFlowResults:
+    """Preallocated per-step results of a time-series power flow.
+
+    Args:
+        steps (int): Number of steps.
+        buses (Sequence): Index of each bus in the network.
+        lines (Sequence): Index of each line in the network.
+        trafos (Sequence): Index of each transformer in the network.
+
+    Attributes:
+        vm_pu (np.ndarray): Voltage magnitude of each bus. [pu] (steps x buses)
+        va_degree (np.ndarray): Voltage angle of each bus. [deg] (steps x buses)
+        line_loading (np.ndarray): Loading of each line. [%] (steps x lines)
+        trafo_loading (np.ndarray): Loading of each transformer. [%]
+            (steps x trafos)
+        grid_p_mw (np.ndarray): Active power drawn from the external grid. (steps,)
+        grid_q_mvar (np.ndarray): Reactive power drawn from the external grid.
+            (steps,)
+        converged (np.ndarray): True for each step whose power flow converged.
+            Results of other steps are NaN. (steps,)
+    """
+
+    def __init__(self, steps: int, buses: Sequence, lines: Sequence, trafos: Sequence):
+        self.buses = list(buses)
+        self.lines = list(lines)
+        self.trafos = list(trafos)
+        self.vm_pu = np.full((steps, len(self.buses)), np.nan)
+        self.va_degree = np.full((steps, len(self.buses)), np.nan)
+        self.line_loading = np.full((steps, len(self.lines)), np.nan)
+        self.trafo_loading = np.full((steps, len(self.trafos)), np.nan)
+        self.grid_p_mw = np.full(steps, np.nan)
+        self.grid_q_mvar = np.full(steps, np.nan)
+        self.converged = np.zeros(steps, dtype=bool)
+
+    def store(self, t: int, net):
+        """ Copy the power flow results of net into step t. """
+        self.vm_pu[t] = net.res_bus["vm_pu"].to_numpy()
+        self.va_degree[t] = net.res_bus["va_degree"].to_numpy()
+        self.line_loading[t] = net.res_line["loading_percent"].to_numpy()
+        self.trafo_loading[t] = net.res_trafo["loading_percent"].to_numpy()
+        self.grid_p_mw[t] = net.res_ext_grid["p_mw"].sum()
+        self.grid_q_mvar[t] = net.res_ext_grid["q_mvar"].sum()
+        self.converged[t] = True
+
+    def bus_voltage(self, bus) -> np.ndarray:
+        """ Voltage magnitude of bus at each step. [pu] """
+        return self.vm_pu[:, self.buses.index(bus)]
+
+
+class TimeSeriesPowerFlow:
+    """Runs a power flow at each step of a load profile on one network.
+
+    Rather than building a new network for each step, the network is built once and
+    only its load table is updated between solves. After the first step, each solve
+    reuses the admittance matrix and internal case of the previous one (runpp's
+    recycle option) and starts Newton-Raphson from its voltages (init="results").
+    A step which does not converge is recorded as such, and the next step starts
+    from scratch.
+
+    Args:
+        net (pandapower.auxiliary.pandapowerNet): Network to solve. Its loads are
+            overwritten during runs.
+        loads (Sequence[int]): Indices of the loads set by the profiles. Defaults to
+            all loads.
+        warm_start (bool): If True, start each solve from the previous voltages.
+        recycle (bool): If True, reuse the admittance matrix between solves.
+        **runpp_kwargs: Other arguments of pandapower.runpp.
+    """
+
+    def __init__(
+        self,
+        net,
+        loads: Optional[Sequence[int]] = None,
+        warm_start: bool = True,
+        recycle: bool = True,
+        **runpp_kwargs,
+    ):
+        self.net = net
+        self.loads = list(net.load.index if loads is None else loads)
+        self.warm_start = warm_start
+        self.recycle = recycle
+        self.runpp_kwargs = runpp_kwargs
+        self._rows = net.load.index.get_indexer(self.loads)
+        self._p_col = net.load.columns.get_loc("p_mw")
+        self._q_col = net.load.columns.get_loc("q_mvar")
+
+    def load_matrix(self, profile) -> np.ndarray:
+        """Per-step load of each load as a (steps x loads) array.
+
+        Args:
+            profile (array-like): Either one value per step, applied to every load,
+                or a (steps x loads) array. [MW or Mvar]
+        """
+        profile = np.asarray(profile, dtype=float)
+        if profile.ndim == 1:
+            profile = profile[:, np.newaxis]
+        return np.broadcast_to(profile, (profile.shape[0], len(self.loads)))
+
+    def run(self, p_mw, q_mvar=None, progress: bool = False) -> PowerFlowResults:
+        """Solve the network at each step of the load profiles.
+
+        Args:
+            p_mw (array-like): Active power of the loads, as accepted by
+                load_matrix. [MW]
+            q_mvar (array-like): Reactive power of the loads, as accepted by
+                load_matrix. Defaults to leaving the reactive power unchanged.
+                [Mvar]
+            progress (bool): If True, show a progress bar.
+
+        Returns:
+            PowerFlowResults: Results of each step.
+        """
+        p_mw = self.load_matrix(p_mw)
+        q_mvar = None if q_mvar is None else self.load_matrix(q_mvar)
+        net = self.net
+        results = PowerFlowResults(
+            len(p_mw), net.bus.index, net.line.index, net.trafo.index
+        )
+        solved = False
+        steps = range(len(p_mw))
+        for t in tqdm(steps) if progress else steps:
+            net.load.iloc[self._rows, self._p_col] = p_mw[t]
+            if q_mvar is not None:
+                net.load.iloc[self._rows, self._q_col] = q_mvar[t]
+            kwargs = dict(self.runpp_kwargs)
+            if solved:
+                if self.warm_start:
+                    kwargs["init"] = "results"
+                if self.recycle:
+                    kwargs["recycle"] = recycle_options()
+            try:
+                pp.runpp(net, **kwargs)
+            except pp.LoadflowNotConverged:
+                solved = False
+                continue
+            results.store(t, net)
+            solved = True
+        return results
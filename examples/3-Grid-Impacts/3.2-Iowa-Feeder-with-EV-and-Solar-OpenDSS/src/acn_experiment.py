@@ -17,6 +17,24 @@ from adacharge import (
     aggregate_power,
 )
 
+# noinspection PyUnresolvedReferences
+from cache import ExperimentCache, array_digest, config_digest, library_versions
+
+# noinspection PyUnresolvedReferences
+from sim_store import SimulationArrays
+
+# noinspection PyUnresolvedReferences
+from event_store import EventStore
+
+# noinspection PyUnresolvedReferences
+from profiling import StageTimer
+
+# noinspection PyUnresolvedReferences
+import parameterized_scheduling as ps
+
+# Formats in which finished simulations can be stored.
+STORAGE_FORMATS = ("json", "arrays")
+
 
 API_KEY = "DEMO_TOKEN"
 
@@ -38,6 +56,40 @@ class ACNExperiment:
         default_battery_power (float): Assumed maximum battery power for each EV. [kW]
         alg_name (str): Name of the algorithm to use.
         tariff_name (str): Name of the tariff to use.
+        external_load (np.ndarray): Other load at the bus, used by load flattening.
+            [kW]
+        external_load_name (str): Human readable label for external_load. Recorded
+            in the cache manifest but not part of the cache key.
+        bus_transformer_cap (float): Capacity of the transformer feeding the bus.
+            [kW]
+        cache_max_entries (int): Maximum number of simulations to keep in sim_dir.
+            Least recently used simulations are evicted first. None for no limit.
+        cache_max_bytes (int): Maximum total size of the simulations in sim_dir.
+            None for no limit.
+        storage (str): Format used to store finished simulations. "json" stores the
+            full Simulator. "arrays" stores only the charging rates and network
+            arrays (see SimulationArrays), which are much smaller and faster to
+            load, but self.sim is then None when loaded from the cache.
+        compress_arrays (bool): With storage="arrays", compress the charging rates.
+            Compressed rates can not be memory-mapped.
+        parameterized (bool): If True, the optimization-based algorithms compile
+            their cvxpy problem once per optimization horizon and re-solve it with
+            new parameters (see ParameterizedSchedulingAlgorithm), instead of
+            rebuilding it at every call.
+        event_store (EventStore): Local store of charging sessions. Windows it
+            covers are served from memory. Windows it does not cover are fetched
+            as before and then added to it, so later overlapping windows are
+            served from memory too.
+        profile (Union[bool, str]): If True, record the wall time of each stage of
+            run, including every scheduler call, in self.timer (see StageTimer).
+            If "trace", also keep every call, so the run can be written with
+            self.timer.to_chrome_trace.
+        solver_options (Dict[str, Dict]): Other keyword arguments of
+            cp.Problem.solve for each solver, by solver name, e.g.
+            {"MOSEK": {"mosek_params": {"MSK_IPAR_NUM_THREADS": 1}}}. Only used by
+            the parameterized algorithms, since AdaptiveSchedulingAlgorithm takes
+            no solver options. Not part of the cache key, so they should not change
+            the results (e.g. thread counts).
 
     Returns:
         acnsim.EventQueue: Queue of events to drive the simulation.
@@ -55,7 +107,15 @@ class ACNExperiment:
         bus_transformer_cap=225,
         events_dir="events",
         sim_dir="sims",
-        sim_timezone="America/Los_Angeles"
+        sim_timezone="America/Los_Angeles",
+        cache_max_entries=None,
+        cache_max_bytes=None,
+        storage="json",
+        compress_arrays=False,
+        parameterized=False,
+        event_store: EventStore = None,
+        profile=False,
+        solver_options=None,
     ):
         self.timezone = pytz.timezone(sim_timezone)
         self.start = self.timezone.localize(start)
@@ -69,9 +129,21 @@ class ACNExperiment:
         self.external_load = external_load
         self.external_load_name = external_load_name
         self.bus_transformer_capacity = bus_transformer_cap
+        if storage not in STORAGE_FORMATS:
+            raise ValueError(
+                f"Unknown storage format {storage}. Options are {STORAGE_FORMATS}."
+            )
+        self.storage = storage
+        self.compress_arrays = compress_arrays
+        self.parameterized = parameterized
         self.sim = None
+        self.results = None
         self.events_dir = events_dir
+        self.event_store = event_store
+        self.timer = StageTimer.from_profile(profile)
+        self.solver_options = dict(solver_options or {})
         self.sim_dir = sim_dir
+        self.cache = ExperimentCache(sim_dir, cache_max_entries, cache_max_bytes)
 
     def events_filename(self):
         """ Filename under which to store the the events queue."""
@@ -81,25 +153,57 @@ class ACNExperiment:
         )
         return os.path.join(self.events_dir, filename)
 
+    def config(self):
+        """Normalized configuration which determines the simulation results.
+
+        external_load enters through a digest of its contents, and the versions of
+        the simulation libraries are included so upgrades invalidate old results.
+        """
+        return {
+            "site": self.site,
+            "start": iso_format_basic(self.start),
+            "end": iso_format_basic(self.end),
+            "period": self.period,
+            "voltage": self.voltage,
+            "default_battery_power": self.default_battery_power,
+            "alg_name": self.alg_name,
+            "tariff_name": self.tariff_name,
+            "external_load": array_digest(self.external_load),
+            "bus_transformer_capacity": self.bus_transformer_capacity,
+            "storage": self.storage,
+            "parameterized": self.parameterized,
+            "versions": library_versions(),
+        }
+
+    def cache_key(self):
+        """ Digest of the normalized configuration. """
+        return config_digest(self.config())
+
     def sim_filename(self):
         """ Filename under which to store the ACN-Sim simulation. """
-        filename = (
-            f"site-{self.site}_start-{iso_format_basic(self.start)}"
-            f"_end-{iso_format_basic(self.end)}"
-            f"_alg_name-{self.alg_name}_tariff_name-{self.tariff_name}"
-            f"_external_load_name-{self.external_load_name}.json"
-        )
-        return os.path.join(self.sim_dir, filename)
+        suffix = ".json" if self.storage == "json" else ".npsim"
+        return self.cache.path(self.cache_key(), suffix)
 
     def get_events(self):
-        """Get events via the ACN-Data API.
+        """Get events from the event store, or via the ACN-Data API.
 
         Returns:
             acnsim.EventQueue: Queue of events to drive the simulation.
         """
+        store = self.event_store
+        if store is not None and store.covers(
+            self.site, self.start, self.end, self.period
+        ):
+            return store.events(
+                self.site,
+                self.start,
+                self.end,
+                self.period,
+                self.default_battery_power,
+            )
         filename = self.events_filename()
         if os.path.exists(filename):
-            return acnsim.EventQueue.from_json(filename)
+            events = acnsim.EventQueue.from_json(filename)
         else:
             events = acnsim.acndata_events.generate_events(
                 API_KEY,
@@ -110,10 +214,11 @@ class ACNExperiment:
                 self.voltage,
                 self.default_battery_power,
             )
-            if not os.path.exists(self.events_dir):
-                os.makedirs(self.events_dir)
+            os.makedirs(self.events_dir, exist_ok=True)
             events.to_json(filename)
-            return events
+        if store is not None:
+            store.add_events(self.site, self.start, self.end, self.period, events)
+        return events
 
     def get_charging_network(self):
         """Get charging network by name.
@@ -177,6 +282,10 @@ class ACNExperiment:
             return algorithms.UncontrolledCharging()
         elif self.alg_name == "llf":
             return algorithms.SortedSchedulingAlgo(algorithms.least_laxity_first)
+        elif self.parameterized and (
+            self.alg_name == "min_cost" or "load_flattening" in self.alg_name
+        ):
+            return self.get_parameterized_algorithm()
         elif self.alg_name == "min_cost":
             revenue = 0.3
             objective = [
@@ -211,11 +320,55 @@ class ACNExperiment:
                     objective, solver="MOSEK", max_recompute=1, peak_limit=peak_limit
                 )
 
-    def build(self):
-        """ Build experiment from configuration. """
-        events = self.get_events()
+    def get_parameterized_algorithm(self):
+        """Parameterized equivalent of the min_cost and load_flattening algorithms.
+
+        Returns:
+            ParameterizedSchedulingAlgorithm
+        """
+        if self.alg_name == "min_cost":
+            revenue = 0.3
+            objective = [
+                ps.TotalEnergy(revenue),
+                ps.TOUEnergyCost(),
+                ps.DaysRemainingScaleDemandCharge(),
+                ps.QuickCharge(1e-4),
+                ps.EqualShare(1e-9),
+            ]
+            return ps.ParameterizedSchedulingAlgorithm(
+                objective,
+                solver="MOSEK",
+                max_recompute=1,
+                solver_options=self.solver_options.get("MOSEK"),
+            )
+        peak_limit = (self.bus_transformer_capacity - self.external_load) * 1000 / 208
+        objective = [
+            ps.TotalEnergy(100),
+            ps.LoadFlattening(
+                1, external_signal=self.external_load, scaling_factor=100
+            ),
+            ps.QuickCharge(1e-3),
+        ]
+        solver = "ECOS" if "ECOS" in self.alg_name else "MOSEK"
+        return ps.ParameterizedSchedulingAlgorithm(
+            objective,
+            solver=solver,
+            max_recompute=1,
+            peak_limit=peak_limit,
+            solver_options=self.solver_options.get(solver),
+        )
+
+    def build(self, scheduler=None):
+        """Build experiment from configuration.
+
+        Args:
+            scheduler (BaseAlgorithm): Scheduler to use instead of the one named by
+                alg_name.
+        """
+        with self.timer.stage("get_events"):
+            events = self.get_events()
         network = self.get_charging_network()
-        sch = self.get_scheduling_algorithm()
+        sch = scheduler if scheduler is not None else self.get_scheduling_algorithm()
         signals = {"tariff": TimeOfUseTariff(self.tariff_name)}
         return acnsim.Simulator(
             network, sch, events, self.start, period=self.period, signals=signals
@@ -223,21 +376,51 @@ class ACNExperiment:
 
     def run(self):
         """ Run internal simulation. """
-        filename = self.sim_filename()
-        if os.path.exists(filename):
-            self.sim = acnsim.Simulator.from_json(filename)
+        timer = self.timer
+        key = self.cache_key()
+        with timer.stage("cache_lookup"):
+            filename = self.cache.lookup(key)
+        if filename is not None and self.storage == "arrays":
+            with timer.stage("load"):
+                self.results = SimulationArrays.load(filename)
+        elif filename is not None:
+            with timer.stage("load"):
+                self.sim = acnsim.Simulator.from_json(filename)
+            self.results = SimulationArrays.from_simulator(self.sim)
         else:
-            self.sim = self.build()
-            self.sim.run()
-            if not os.path.exists(self.sim_dir):
-                os.makedirs(self.sim_dir)
-            self.sim.to_json(filename)
+            with timer.stage("build"):
+                self.sim = self.build()
+            with timer.stage("simulate"), timer.patch(
+                self.sim.scheduler, "run", "scheduler"
+            ):
+                self.sim.run()
+            config = dict(self.config(), external_load_name=self.external_load_name)
+            self.results = SimulationArrays.from_simulator(self.sim, config)
+            filename = self.sim_filename()
+            os.makedirs(self.sim_dir, exist_ok=True)
+            with timer.stage("save"):
+                if self.storage == "arrays":
+                    self.results.save(filename, compress=self.compress_arrays)
+                else:
+                    self.sim.to_json(filename)
+                self.cache.add(key, filename, config)
+
+    def aggregate_power(self):
+        """ Aggregate charging power at each step of the finished simulation. [kW] """
+        return self.results.aggregate_power()
+
+    def constraint_currents(self, return_magnitudes=False):
+        """ Current through each constraint at each step of the finished simulation. """
+        return self.results.constraint_currents(return_magnitudes=return_magnitudes)
 
 
 if __name__ == "__main__":
-    tz = pytz.timezone("America/Los_Angeles")
-    start_time = tz.localize(datetime(2019, 7, 1))
-    end_time = tz.localize(datetime(2019, 8, 1))
+    # noinspection PyUnresolvedReferences
+    from sweep import run_sweep
+
+    # ACNExperiment localizes start and end to sim_timezone itself.
+    start_time = datetime(2019, 7, 1)
+    end_time = datetime(2019, 8, 1)
     sites = ["jpl", "caltech"]
     algs = ["unctrl", "min_cost", "llf"]
     tariffs = [
@@ -245,16 +428,19 @@ if __name__ == "__main__":
         "sce_tou_ev_8_june_2019",
         "pge_a10_tou_aug_2019",
     ]
+    configs = []
     for site in sites:
         for alg in algs:
             for tariff in tariffs:
-                config = {
-                    "site": site,
-                    "start": start_time,
-                    "end": end_time,
-                    "alg_name": alg,
-                    "tariff_name": tariff if alg != "min_cost" else tariffs[0],
-                }
-                print(config)
-                ex = ACNExperiment(**config)
-                ex.run()
+                configs.append(
+                    {
+                        "site": site,
+                        "start": start_time,
+                        "end": end_time,
+                        "alg_name": alg,
+                        "tariff_name": tariff if alg != "min_cost" else tariffs[0],
+                    }
+                )
+    for result in run_sweep(configs):
+        if result["status"] == "failed":
+            print(result["config"], result["error"])
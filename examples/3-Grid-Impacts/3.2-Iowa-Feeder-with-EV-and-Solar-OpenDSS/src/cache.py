@@ -0,0 +1,169 @@
+# coding=utf-8
+"""
+Content-addressed cache for experiment results.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    from importlib.metadata import version, PackageNotFoundError
+except ImportError:  # Python < 3.8
+    from importlib_metadata import version, PackageNotFoundError
+
+# Libraries whose versions can change simulation results.
+VERSIONED_LIBRARIES = ("acnportal", "adacharge", "cvxpy", "numpy")
+
+
+def array_digest(array: Optional[np.ndarray]) -> Optional[str]:
+    """ Stable digest of the dtype, shape and contents of an array. """
+    if array is None:
+        return None
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha256()
+    h.update(str(array.dtype).encode())
+    h.update(str(array.shape).encode())
+    h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def config_digest(config: Dict) -> str:
+    """ Stable digest of a JSON-serializable configuration. """
+    normalized = json.dumps(config, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def library_versions() -> Dict[str, Optional[str]]:
+    """ Installed version of each library in VERSIONED_LIBRARIES. """
+    versions = {}
+    for library in VERSIONED_LIBRARIES:
+        try:
+            versions[library] = version(library)
+        except PackageNotFoundError:
+            versions[library] = None
+    return versions
+
+
+class ExperimentCache:
+    """Directory of result files keyed by configuration digest.
+
+    A manifest in the directory maps each key to its file, size, configuration and
+    last access time, so lookups never scan the directory. When max_entries or
+    max_bytes is set, the least recently used entries are evicted on insert.
+
+    Args:
+        cache_dir (str): Directory holding the cached files and the manifest.
+        max_entries (int): Maximum number of entries to keep. None for no limit.
+        max_bytes (int): Maximum total size of the cached files. None for no limit.
+    """
+
+    manifest_name = "manifest.json"
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.cache_dir, self.manifest_name)
+
+    def path(self, key: str, suffix: str = ".json") -> str:
+        """ Path at which to store the entry for key. """
+        return os.path.join(self.cache_dir, f"{key}{suffix}")
+
+    @contextmanager
+    def _manifest(self):
+        """ Locked read-modify-write access to the manifest. """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+            else:
+                manifest = {}
+            yield manifest
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.manifest_path)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """ Return the path of the entry for key and mark it used, or None. """
+        with self._manifest() as manifest:
+            entry = manifest.get(key)
+            if entry is None:
+                return None
+            path = os.path.join(self.cache_dir, entry["filename"])
+            if not os.path.exists(path):
+                del manifest[key]
+                return None
+            entry["last_access"] = time.time()
+            return path
+
+    def add(self, key: str, path: str, config: Optional[Dict] = None):
+        """ Register the file at path (inside cache_dir) as the entry for key. """
+        with self._manifest() as manifest:
+            now = time.time()
+            manifest[key] = {
+                "filename": os.path.relpath(path, self.cache_dir),
+                "bytes": self._size(path),
+                "config": config,
+                "created": now,
+                "last_access": now,
+            }
+            self._evict(manifest, keep=key)
+
+    def evict(self):
+        """ Evict least recently used entries until within the configured limits. """
+        with self._manifest() as manifest:
+            self._evict(manifest)
+
+    @staticmethod
+    def _size(path: str) -> int:
+        if os.path.isdir(path):
+            return sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path)
+                for name in names
+            )
+        return os.path.getsize(path)
+
+    def _evict(self, manifest: Dict, keep: Optional[str] = None):
+        def over_limit():
+            return (
+                self.max_entries is not None and len(manifest) > self.max_entries
+            ) or (
+                self.max_bytes is not None
+                and sum(e["bytes"] for e in manifest.values()) > self.max_bytes
+            )
+
+        by_age = sorted(
+            (k for k in manifest if k != keep), key=lambda k: manifest[k]["last_access"]
+        )
+        for key in by_age:
+            if not over_limit():
+                break
+            path = os.path.join(self.cache_dir, manifest.pop(key)["filename"])
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
@@ -5,7 +5,6 @@ Objects and wrappers to run an ACN-Sim + OpenDSS co-simulation.
 from typing import Optional, Dict
 
 import numpy as np
-from acnportal import acnsim
 
 # noinspection PyUnresolvedReferences
 from acn_experiment import ACNExperiment
@@ -13,6 +12,21 @@ from acn_experiment import ACNExperiment
 # noinspection PyUnresolvedReferences
 from opendss_experiment import OpenDSSExperiment
 
+# Constraints whose currents feed phases A, B and C of the bus, by site.
+PHASE_CONSTRAINTS = {
+    "caltech": tuple((f"Secondary {p}",) for p in "ABC"),
+    "jpl": tuple(
+        (
+            f"Third/Fourth Floor Transformer Secondary {p}",
+            f"First Floor Transformer Secondary {p}",
+        )
+        for p in "ABC"
+    ),
+}
+
+# Line to neutral voltage phasor of phases A, B and C of the bus. [V]
+PHASE_VOLTAGES = 120 * np.exp(1j * np.deg2rad([0, -120, 120]))
+
 
 class ACNOpenDSSCompositeExperiment:
     """Class container for ACN-Sim + OpenDSS co-simulation.
@@ -55,51 +69,63 @@ class ACNOpenDSSCompositeExperiment:
         self.unbalanced = unbalanced
         self.ev_load_offset = ev_load_offset
 
-    def add_acn_load(self, acn_bus):
-        acn_experiment = self.acn_experiments[acn_bus]
+    def acn_load_array(self, buses=None, rates=None):
+        """Power drawn by the ACN experiments, on each phase, at each step.
+
+        Args:
+            buses (List[str]): ACN buses to include. Defaults to all acn_buses.
+            rates (Dict[str, np.ndarray]): Charging rates to use for some buses
+                instead of the stored results of their experiments, e.g. one step
+                of a running simulation. (stations x T) [A]
+
+        Returns:
+            np.ndarray: (buses x phases x T) complex power, in the order of
+                buses. There are 3 phases if unbalanced, else 1. Experiments
+                shorter than the longest are padded with zeros. [kW + j kvar]
+        """
+        rates = rates if rates is not None else {}
+        per_bus = []
+        for acn_bus in buses if buses is not None else self.acn_buses:
+            acn_experiment = self.acn_experiments[acn_bus]
+            results = acn_experiment.results
+            bus_rates = rates.get(acn_bus, results.charging_rates)
+            if self.unbalanced:
+                magnitudes = results.constraints.group_magnitudes(
+                    bus_rates, PHASE_CONSTRAINTS[acn_experiment.site]
+                )
+                per_bus.append(
+                    PHASE_VOLTAGES[:, np.newaxis] * np.conj(magnitudes) / 1000
+                )
+            else:
+                power = results.voltages @ np.asarray(bus_rates) / 1000
+                per_bus.append(power[np.newaxis, :])
+        steps = max(load.shape[-1] for load in per_bus)
+        loads = np.zeros((len(per_bus), per_bus[0].shape[0], steps), dtype=complex)
+        for i, load in enumerate(per_bus):
+            loads[i, :, : load.shape[-1]] = load
+        return loads
+
+    def acn_load_names(self, buses=None):
+        """ OpenDSS load names matching the first two axes of acn_load_array. """
+        buses = buses if buses is not None else self.acn_buses
         if self.unbalanced:
-            ev_load = acnsim.constraint_currents(
-                acn_experiment.sim, return_magnitudes=True
-            )
-            if acn_experiment.site == "jpl":
-                for phase in "ABC":
-                    ev_load[f"Secondary {phase}"] = (
-                        ev_load[f"Third/Fourth Floor Transformer Secondary {phase}"]
-                        + ev_load[f"First Floor Transformer Secondary {phase}"]
-                    )
-
-            voltages = {
-                "Secondary A": 120,
-                "Secondary B": 120 * np.exp(1j * np.deg2rad(-120)),
-                "Secondary C": 120 * np.exp(1j * np.deg2rad(120)),
-            }
-            for phase in voltages:
-                ev_load[phase] = voltages[phase] * np.conj(ev_load[phase]) / 1000
-
-            # horizon = ev_load["Secondary A"].shape[0]
-            # baseline_load = (
-            #     dss_ex.P[f"load_{acn_bus}"][:horizon]
-            #     + 1j * dss_ex.Q[f"load_{acn_bus}"][:horizon]
-            # ) / 3
-            self.open_dss_experiment.add_load(
-                [f"load_{acn_bus}_a"], ev_load["Secondary A"], self.ev_load_offset
-            )
-            self.open_dss_experiment.add_load(
-                [f"load_{acn_bus}_b"], ev_load["Secondary B"], self.ev_load_offset
-            )
-            self.open_dss_experiment.add_load(
-                [f"load_{acn_bus}_c"], ev_load["Secondary C"], self.ev_load_offset
-            )
-        else:
-            self.open_dss_experiment.add_load(
-                [f"load_{acn_bus}"],
-                acnsim.aggregate_power(acn_experiment.sim),
-                self.ev_load_offset,
-            )
+            return [[f"load_{bus}_{p}" for p in "abc"] for bus in buses]
+        return [[f"load_{bus}"] for bus in buses]
 
-    def add_acn_loads(self):
-        for acn_bus in self.acn_buses:
-            self.add_acn_load(acn_bus)
+    def add_acn_load(self, acn_bus):
+        """ Add the load of the ACN experiment at acn_bus to the feeder. """
+        self.add_acn_loads([acn_bus])
+
+    def add_acn_loads(self, buses=None):
+        """ Add the load of the ACN experiments to the feeder in one batch. """
+        buses = list(buses if buses is not None else self.acn_buses)
+        if not buses:
+            return
+        loads = self.acn_load_array(buses)
+        names = [name for bus_names in self.acn_load_names(buses) for name in bus_names]
+        self.open_dss_experiment.add_loads(
+            names, loads.reshape(len(names), -1), int(self.ev_load_offset)
+        )
 
     def add_general_load(
         self, load_bus: str, load: np.ndarray, load_offset: float = 0
@@ -113,13 +139,13 @@ class ACNOpenDSSCompositeExperiment:
     def add_general_loads(
         self, load: np.ndarray, load_offset: float = 0, buses=None
     ) -> None:
-        """Adds a to all acn buses."""
-        if buses is None:
-            for acn_bus in self.acn_buses:
-                self.add_general_load(acn_bus, load, load_offset)
-        else:
-            for bus in buses:
-                self.add_general_load(bus, load, load_offset)
+        """Adds a load to all acn buses (or the given buses) in one batch."""
+        buses = buses if buses is not None else self.acn_buses
+        names = [f"load_{bus}" for bus in buses]
+        load = np.asarray(load)
+        self.open_dss_experiment.add_loads(
+            names, np.broadcast_to(load, (len(names), len(load))), int(load_offset)
+        )
 
     def run_dss(self, detailed_metrics=True):
         """ Run the OpenDSS experiment. """
@@ -0,0 +1,135 @@
+# coding=utf-8
+"""
+Infrastructure constraints of a charging network compiled to a sparse phasor matrix.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+from scipy import sparse
+
+
+class CompiledConstraints:
+    """Constraints of a charging network as one sparse complex matrix.
+
+    Row i, column j holds the coefficient of station j in constraint i times the
+    phasor of station j's phase angle, so the current phasor through every
+    constraint at every step is a single sparse product with the rate matrix. Each
+    constraint usually involves a small share of the stations, so the product scales
+    with the number of nonzero coefficients rather than constraints x stations.
+
+    Args:
+        constraint_matrix (np.ndarray): Coefficients of each constraint.
+            (constraints x stations)
+        constraint_ids (List[str]): Name of each constraint.
+        phase_angles (np.ndarray): Phase angle of each station. [degrees]
+        station_ids (List[str]): Station id of each column.
+        limits (np.ndarray): Current limit of each constraint, if known. [A]
+    """
+
+    def __init__(
+        self,
+        constraint_matrix: np.ndarray,
+        constraint_ids: List[str],
+        phase_angles: np.ndarray,
+        station_ids: Optional[List[str]] = None,
+        limits: Optional[np.ndarray] = None,
+    ):
+        phasors = np.exp(1j * np.deg2rad(np.asarray(phase_angles, dtype=float)))
+        self.matrix = sparse.csr_matrix(np.asarray(constraint_matrix) * phasors)
+        self.constraint_ids = list(constraint_ids)
+        self.station_ids = list(station_ids) if station_ids is not None else None
+        self.limits = np.asarray(limits, dtype=float) if limits is not None else None
+        self._rows = {c: i for i, c in enumerate(self.constraint_ids)}
+        self._subsets = {}
+
+    @classmethod
+    def from_network(cls, network):
+        """ Compile the constraints of an acnsim ChargingNetwork. """
+        return cls(
+            network.constraint_matrix,
+            network.constraint_index,
+            network.phase_angles,
+            network.station_ids,
+            network.magnitudes,
+        )
+
+    def _matrix(self, constraint_ids: Optional[Sequence[str]]):
+        """ Rows of the matrix for constraint_ids, cached per selection. """
+        if constraint_ids is None:
+            return self.matrix
+        key = tuple(constraint_ids)
+        if key not in self._subsets:
+            self._subsets[key] = self.matrix[[self._rows[c] for c in key]]
+        return self._subsets[key]
+
+    def currents(self, rates, constraint_ids=None) -> np.ndarray:
+        """Current phasor through each constraint.
+
+        Args:
+            rates (np.ndarray): Charging rate of each station, for one step
+                (stations,) or many (stations x T). [A]
+            constraint_ids (Sequence[str]): Constraints to include, in order.
+                Defaults to all.
+
+        Returns:
+            np.ndarray: (constraints,) or (constraints x T) complex currents. [A]
+        """
+        return self._matrix(constraint_ids) @ np.asarray(rates)
+
+    def magnitudes(self, rates, constraint_ids=None) -> np.ndarray:
+        """ Current magnitude through each constraint, as currents. [A] """
+        return np.abs(self.currents(rates, constraint_ids))
+
+    def constraint_currents(
+        self, rates, return_magnitudes=False, constraint_ids=None
+    ) -> Dict[str, np.ndarray]:
+        """Current through each constraint at each step, by constraint.
+
+        Drop-in replacement for acnsim.constraint_currents given sim.charging_rates.
+        """
+        constraint_ids = (
+            constraint_ids if constraint_ids is not None else self.constraint_ids
+        )
+        if return_magnitudes:
+            currents = self.magnitudes(rates, constraint_ids)
+        else:
+            currents = self.currents(rates, constraint_ids)
+        return dict(zip(constraint_ids, currents))
+
+    def group_magnitudes(self, rates, groups: Iterable[Sequence[str]]) -> np.ndarray:
+        """Summed current magnitude of each group of constraints, e.g. the
+        transformer secondaries feeding each phase of a bus.
+
+        Returns:
+            np.ndarray: (groups,) or (groups x T) currents. [A]
+        """
+        groups = [tuple(group) for group in groups]
+        constraint_ids = [c for group in groups for c in group]
+        magnitudes = self.magnitudes(rates, constraint_ids)
+        sizes = [len(group) for group in groups]
+        membership = sparse.csr_matrix(
+            (
+                np.ones(len(constraint_ids)),
+                np.arange(len(constraint_ids)),
+                np.concatenate([[0], np.cumsum(sizes)]),
+            ),
+            shape=(len(groups), len(constraint_ids)),
+        )
+        return membership @ magnitudes
+
+    def violations(self, rates, violation_tolerance=1e-5) -> np.ndarray:
+        """Amount by which each constraint's current exceeds its limit, or 0.
+
+        Returns:
+            np.ndarray: (constraints,) or (constraints x T) excess currents. [A]
+        """
+        if self.limits is None:
+            raise ValueError("The constraint limits are not known.")
+        limits = self.limits + violation_tolerance
+        if np.ndim(rates) > 1:
+            limits = limits[:, np.newaxis]
+        return np.maximum(self.magnitudes(rates) - limits, 0)
+
+    def is_feasible(self, rates, violation_tolerance=1e-5) -> bool:
+        """ True if no constraint is exceeded at any step of rates. """
+        return not np.any(self.violations(rates, violation_tolerance))
@@ -0,0 +1,322 @@
+# coding=utf-8
+"""
+Closed-loop co-simulation of ACN-Sim and OpenDSS, advanced one period at a time.
+"""
+import time
+from typing import Dict, List
+
+import cvxpy as cp
+import numpy as np
+import opendssdirect as dss
+import pandas as pd
+from adacharge import ObjectiveComponent, aggregate_power
+from tqdm import tqdm
+
+# noinspection PyUnresolvedReferences
+from composite_experiment import ACNOpenDSSCompositeExperiment
+
+# noinspection PyUnresolvedReferences
+from opendss_experiment import metric_families
+
+# noinspection PyUnresolvedReferences
+from parameterized_scheduling import (
+    ParameterizedComponent,
+    ParameterizedSchedulingAlgorithm,
+)
+
+# noinspection PyUnresolvedReferences
+from sim_store import SimulationArrays
+
+# Stages whose wall time is recorded at each step.
+LATENCY_STAGES = ("schedule", "acn_step", "inject", "dss_solve", "feedback")
+
+
+class FeedbackSignals:
+    """Feeder state at each ACN bus, as seen by the schedulers.
+
+    Values are indexed by ACN-Sim iteration and are NaN until the feeder has been
+    solved for that iteration.
+
+    Args:
+        buses (List[str]): ACN buses.
+        steps (int): Number of ACN-Sim iterations to size the signals for.
+
+    Attributes:
+        voltage (Dict[str, np.ndarray]): Lowest per unit voltage of the nodes of
+            each bus.
+        loading (Dict[str, np.ndarray]): Highest loading of the transformers
+            connected to each bus. [% of normal rating]
+    """
+
+    def __init__(self, buses: List[str], steps: int):
+        self.voltage = {bus: np.full(steps, np.nan) for bus in buses}
+        self.loading = {bus: np.full(steps, np.nan) for bus in buses}
+
+    def latest(self, signal: Dict[str, np.ndarray], bus: str, t: int):
+        """ Last value of signal at bus known before iteration t, or NaN. """
+        values = signal[bus][: min(t, len(signal[bus]))]
+        known = values[~np.isnan(values)]
+        return known[-1] if len(known) else np.nan
+
+    def severity(self, bus, t, v_min=0.95, loading_limit=100):
+        """Relative size of the latest voltage and loading violations at bus.
+
+        Args:
+            bus (str): ACN bus.
+            t (int): Current ACN-Sim iteration.
+            v_min (float): Lowest acceptable voltage. [pu]
+            loading_limit (float): Highest acceptable loading. [%]
+
+        Returns:
+            float: 0 if there is no violation (or nothing is known yet), else the
+                sum of the relative voltage deficit and loading excess.
+        """
+        voltage = self.latest(self.voltage, bus, t)
+        loading = self.latest(self.loading, bus, t)
+        severity = 0.0
+        if not np.isnan(voltage):
+            severity += max(0.0, (v_min - voltage) / v_min)
+        if not np.isnan(loading):
+            severity += max(0.0, (loading - loading_limit) / loading_limit)
+        return severity
+
+
+def feedback_penalty(
+    rates,
+    infrastructure,
+    interface,
+    feedback=None,
+    bus=None,
+    v_min=0.95,
+    loading_limit=100,
+    **kwargs,
+):
+    """Penalty on the charging power of the next period while the feeder reports a
+    voltage or loading violation at the bus. For use in an ObjectiveComponent.
+    """
+    severity = feedback.severity(bus, interface.current_time, v_min, loading_limit)
+    return -severity * aggregate_power(rates[:, :1], infrastructure)[0]
+
+
+class FeedbackPenalty(ParameterizedComponent):
+    """Parameterized counterpart of feedback_penalty.
+
+    Args:
+        feedback (FeedbackSignals): Signals updated by the co-simulation.
+        bus (str): ACN bus of the scheduler.
+        v_min (float): Lowest acceptable voltage. [pu]
+        loading_limit (float): Highest acceptable loading. [%]
+    """
+
+    def __init__(
+        self, coefficient=1, feedback=None, bus=None, v_min=0.95, loading_limit=100
+    ):
+        super().__init__(coefficient)
+        self.feedback = feedback
+        self.bus = bus
+        self.v_min = v_min
+        self.loading_limit = loading_limit
+
+    def build(self, rates, infrastructure, period):
+        severity = cp.Parameter(nonneg=True, name="severity")
+        power = (infrastructure.voltages / 1000) @ rates[:, 0]
+        return -severity * power, {"severity": severity}
+
+    def update(self, params, interface, infrastructure, horizon):
+        params["severity"].value = self.feedback.severity(
+            self.bus, interface.current_time, self.v_min, self.loading_limit
+        )
+
+
+class CoSimulation:
+    """Lockstep co-simulation of the ACN-Sim experiments and feeder of a composite.
+
+    Every period, each ACN-Sim is advanced one iteration with Simulator.step (as in
+    the acnportal gym interface). Its charging power for that iteration is then
+    injected into the feeder, which is solved for that step only. The feeder state
+    at each ACN bus is published in a FeedbackSignals object, which schedulers read
+    through feedback_penalty (or FeedbackPenalty) at their next call.
+
+    The feeder is compiled once (persistent_circuit is forced on). Set carry_taps on
+    the OpenDSS experiment for regulator taps to evolve as they would in real time.
+
+    Args:
+        composite (ACNOpenDSSCompositeExperiment): Experiments to couple. Any
+            general (e.g. solar) loads should already have been added.
+        feedback_coefficient (float): Weight of the feedback penalty added to each
+            optimization-based scheduler. 0 to run open loop.
+        v_min (float): Lowest acceptable voltage. [pu]
+        loading_limit (float): Highest acceptable transformer loading. [%]
+        detailed_metrics (Union[bool, Iterable[str]]): Passed to the OpenDSS
+            experiment. The capacity family is always collected when any bus has a
+            transformer, since transformer loading is fed back.
+
+    Attributes:
+        feedback (FeedbackSignals): Feeder state at each ACN bus.
+        latency (pd.DataFrame): Wall time of each stage (columns) at each
+            iteration (rows). [s]
+    """
+
+    def __init__(
+        self,
+        composite: ACNOpenDSSCompositeExperiment,
+        feedback_coefficient: float = 1.0,
+        v_min: float = 0.95,
+        loading_limit: float = 100,
+        detailed_metrics=False,
+    ):
+        self.composite = composite
+        self.feedback_coefficient = feedback_coefficient
+        self.v_min = v_min
+        self.loading_limit = loading_limit
+        self.detailed_metrics = detailed_metrics
+        self.feedback = None
+        self.latency = None
+
+    def _scheduler(self, bus, acn_experiment):
+        """ Scheduler of acn_experiment with the feedback penalty added. """
+        scheduler = acn_experiment.get_scheduling_algorithm()
+        if self.feedback_coefficient:
+            settings = {
+                "feedback": self.feedback,
+                "bus": bus,
+                "v_min": self.v_min,
+                "loading_limit": self.loading_limit,
+            }
+            if isinstance(scheduler, ParameterizedSchedulingAlgorithm):
+                scheduler.objective.append(
+                    FeedbackPenalty(self.feedback_coefficient, **settings)
+                )
+            elif hasattr(scheduler, "objective"):
+                scheduler.objective.append(
+                    ObjectiveComponent(
+                        feedback_penalty, self.feedback_coefficient, settings
+                    )
+                )
+        return scheduler
+
+    @staticmethod
+    def _bus_elements(load_names, node_names):
+        """ Node indices and transformer PDElement indices at the bus of loads. """
+        buses = set()
+        for name in load_names:
+            dss.Loads.Name(name)
+            buses.add(dss.CktElement.BusNames()[0].split(".")[0].lower())
+        nodes = [
+            i
+            for i, node in enumerate(node_names)
+            if node.split(".")[0].lower() in buses
+        ]
+        pd_elements = [name.lower() for name in dss.PDElements.AllNames()]
+        transformers = []
+        for name in dss.Transformers.AllNames():
+            dss.Circuit.SetActiveElement(f"Transformer.{name}")
+            terminals = {b.split(".")[0].lower() for b in dss.CktElement.BusNames()}
+            if terminals & buses:
+                transformers.append(pd_elements.index(f"transformer.{name.lower()}"))
+        return nodes, transformers
+
+    def _inject(self, k, t, sims, buses, load_names):
+        """ Add the charging power of ACN-Sim iteration k to feeder step t. """
+        composite = self.composite
+        columns = {}
+        for bus, sim in sims.items():
+            rates = np.asarray(sim.charging_rates)
+            column = rates[:, k : k + 1]
+            if column.shape[1] == 0:
+                column = np.zeros((rates.shape[0], 1))
+            columns[bus] = column
+        loads = composite.acn_load_array(buses, rates=columns)
+        composite.open_dss_experiment.add_loads(
+            load_names, loads.reshape(len(load_names), -1), first_step=t
+        )
+
+    def run(self):
+        """ Run the co-simulation. """
+        composite = self.composite
+        dss_experiment = composite.open_dss_experiment
+        dss_experiment.persistent_circuit = True
+        buses = list(composite.acn_buses)
+        offset = int(composite.ev_load_offset)
+        dss_steps = dss_experiment.horizon // dss_experiment.period
+        steps = offset + dss_steps
+        self.feedback = FeedbackSignals(buses, steps)
+
+        sims = {}
+        for bus, acn_experiment in composite.acn_experiments.items():
+            scheduler = self._scheduler(bus, acn_experiment)
+            sims[bus] = acn_experiment.build(scheduler=scheduler)
+            # Every iteration must return to the co-simulation loop.
+            sims[bus].max_recompute = 1
+            acn_experiment.sim = sims[bus]
+            acn_experiment.results = SimulationArrays.from_simulator(sims[bus])
+
+        # start_run compiles the circuit, which _bus_elements reads.
+        families = dss_experiment.start_run(metric_families(self.detailed_metrics))
+        load_names = composite.acn_load_names(buses)
+        elements = {
+            bus: self._bus_elements(names, dss_experiment.results.node_names)
+            for bus, names in zip(buses, load_names)
+        }
+        load_names = [name for names in load_names for name in names]
+        if "capacity" not in families and any(
+            transformers for _, transformers in elements.values()
+        ):
+            families.add("capacity")
+            dss_experiment.allocate_metrics(families)
+
+        latency = []
+        done = {bus: False for bus in buses}
+        progress = tqdm(total=steps)
+        k = 0
+        while k < steps or not all(done.values()):
+            times = dict.fromkeys(LATENCY_STAGES, 0.0)
+            for bus, sim in sims.items():
+                if done[bus]:
+                    continue
+                start = time.perf_counter()
+                schedule = sim.scheduler.run()
+                times["schedule"] += time.perf_counter() - start
+                start = time.perf_counter()
+                done[bus] = sim.step(schedule)
+                times["acn_step"] += time.perf_counter() - start
+
+            t = k - offset
+            if 0 <= t < dss_steps:
+                start = time.perf_counter()
+                self._inject(k, t, sims, buses, load_names)
+                times["inject"] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                dss_experiment.solve_step(t, families)
+                times["dss_solve"] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                self._publish(k, t, elements, families)
+                times["feedback"] = time.perf_counter() - start
+            latency.append(times)
+            k += 1
+            progress.update()
+        progress.close()
+
+        self.latency = pd.DataFrame(latency, columns=LATENCY_STAGES)
+        self.latency["total"] = self.latency.sum(axis=1)
+        for bus, sim in sims.items():
+            results = SimulationArrays.from_simulator(sim)
+            composite.acn_experiments[bus].results = results
+
+    def _publish(self, k, t, elements, families):
+        """ Publish the feeder state at feeder step t as feedback for iteration k. """
+        results = self.composite.open_dss_experiment.results
+        voltages = results.voltages[t]
+        for bus, (nodes, transformers) in elements.items():
+            if nodes:
+                self.feedback.voltage[bus][k] = np.min(voltages[nodes])
+            if transformers and "capacity" in families:
+                loading = results.capacity[1, t, transformers]
+                self.feedback.loading[bus][k] = np.max(loading)
+
+    def real_time_margin(self):
+        """ Fraction of each period left after the work done in that period. """
+        period = self.composite.open_dss_experiment.period * 60
+        return 1 - self.latency["total"] / period
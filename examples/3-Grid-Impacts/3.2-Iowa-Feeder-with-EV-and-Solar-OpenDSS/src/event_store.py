@@ -0,0 +1,252 @@
+# coding=utf-8
+"""
+In-memory store of charging sessions, indexed by site and arrival time.
+"""
+import gzip
+import json
+import os
+import re
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pytz
+from acnportal import acnsim
+
+# Name of an event dump written by the algorithm comparison notebooks, e.g.
+# caltech_20190301T000000_20190401T000000_5m_208V_6.6kW.json.gz. Start and end are
+# local times at the site.
+DUMP_PATTERN = re.compile(
+    r"(?P<site>[a-z]+)_(?P<start>\d{8}T\d{6})_(?P<end>\d{8}T\d{6})"
+    r"_(?P<period>\d+)m_(?P<voltage>\d+)V_(?P<power>[\d.]+)kW\.json(\.gz)?$"
+)
+
+SESSION_COLUMNS = (
+    "session_id",
+    "station_id",
+    "arrival",
+    "departure",
+    "estimated_departure",
+    "requested_energy",
+)
+
+
+def _epoch_seconds(dt: datetime) -> int:
+    """ Seconds since the epoch of a timezone aware datetime. """
+    return int(dt.timestamp())
+
+
+class _Window:
+    """Sessions from one events queue.
+
+    Arrival and departure are stored as the epoch seconds of the start of the
+    period they fall in, so they can be re-expressed relative to any window
+    aligned to the same grid.
+    """
+
+    def __init__(self, start: int, end: int, period: int, sessions: pd.DataFrame):
+        self.start = start
+        self.end = end
+        self.period = period
+        self.sessions = sessions.sort_values("arrival", kind="mergesort")
+        self.arrivals = self.sessions["arrival"].to_numpy()
+
+    def covers(self, start: int, end: int, period: int) -> bool:
+        step = self.period * 60
+        return (
+            self.start <= start
+            and end <= self.end
+            and period % self.period == 0
+            and (start - self.start) % step == 0
+            and (end - self.start) % step == 0
+        )
+
+    def slice(self, start: int, end: int) -> pd.DataFrame:
+        lo, hi = np.searchsorted(self.arrivals, [start, end], side="left")
+        return self.sessions.iloc[lo:hi]
+
+
+def sessions_from_json(data: Dict, start: int, period: int) -> pd.DataFrame:
+    """Sessions of a serialized EventQueue as a DataFrame.
+
+    Args:
+        data (Dict): Decoded output of acnsim.EventQueue.to_json.
+        start (int): Epoch seconds of timestep 0 of the queue.
+        period (int): Length of each timestep of the queue. [min]
+
+    Returns:
+        pd.DataFrame: One row per session with columns SESSION_COLUMNS. Times are
+            epoch seconds.
+    """
+    step = period * 60
+    rows = []
+    for obj in data["context_dict"].values():
+        if not obj["class"].endswith(".EV"):
+            continue
+        ev = obj["attributes"]
+        estimated_departure = ev.get("_estimated_departure")
+        if estimated_departure is None:
+            estimated_departure = ev["_departure"]
+        rows.append(
+            (
+                ev["_session_id"],
+                ev["_station_id"],
+                start + ev["_arrival"] * step,
+                start + ev["_departure"] * step,
+                start + estimated_departure * step,
+                ev["_requested_energy"],
+            )
+        )
+    return pd.DataFrame(rows, columns=SESSION_COLUMNS)
+
+
+class EventStore:
+    """Charging sessions from local event dumps, served for any time window.
+
+    Each loaded dump (or events queue) is kept as a table of sessions sorted by
+    arrival. A request for [start, end) is answered by a binary search on arrival
+    times in the first table which covers the window, without any network access
+    or file I/O.
+
+    Windows must be aligned to the grid of the table they are served from, and
+    their period must be a multiple of its period. Timesteps are then exactly those
+    acndata_events.generate_events would produce for the window.
+
+    Args:
+        timezone (str): Timezone of the local times in dump filenames.
+    """
+
+    def __init__(self, timezone: str = "America/Los_Angeles"):
+        self.timezone = pytz.timezone(timezone)
+        self._windows: Dict[str, List[_Window]] = {}
+
+    @classmethod
+    def from_directory(cls, directory: str, timezone: str = "America/Los_Angeles"):
+        """ Build a store from every event dump in directory. """
+        store = cls(timezone)
+        for filename in sorted(os.listdir(directory)):
+            if DUMP_PATTERN.match(filename):
+                store.load_dump(os.path.join(directory, filename))
+        return store
+
+    def load_dump(self, path: str):
+        """Add the sessions in an event dump to the store.
+
+        Args:
+            path (str): Dump written by the algorithm comparison notebooks, named as
+                DUMP_PATTERN. Gzipped dumps contain a JSON encoded string holding
+                the output of EventQueue.to_json.
+        """
+        match = DUMP_PATTERN.match(os.path.basename(path))
+        if match is None:
+            raise ValueError(f"{path} is not named like an event dump.")
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt") as f:
+            data = json.load(f)
+        if isinstance(data, str):
+            data = json.loads(data)
+        start, end = (
+            self.timezone.localize(datetime.strptime(match[key], "%Y%m%dT%H%M%S"))
+            for key in ("start", "end")
+        )
+        self.add_json(match["site"], start, end, int(match["period"]), data)
+
+    def add_json(self, site: str, start: datetime, end: datetime, period: int, data):
+        """Add the sessions of a serialized EventQueue covering [start, end).
+
+        Args:
+            site (str): Site of the sessions.
+            start (datetime): Timezone aware time of timestep 0 of the queue.
+            end (datetime): Timezone aware end of the window the queue covers.
+            period (int): Length of each timestep of the queue. [min]
+            data (Union[str, Dict]): Output of EventQueue.to_json.
+        """
+        if isinstance(data, str):
+            data = json.loads(data)
+        start, end = _epoch_seconds(start), _epoch_seconds(end)
+        sessions = sessions_from_json(data, start, period)
+        self._windows.setdefault(site, []).append(
+            _Window(start, end, period, sessions)
+        )
+
+    def add_events(
+        self, site: str, start: datetime, end: datetime, period: int, events
+    ):
+        """ Add the sessions of an acnsim.EventQueue covering [start, end). """
+        self.add_json(site, start, end, period, events.to_json())
+
+    def _find(self, site, start, end, period) -> Optional[_Window]:
+        for window in self._windows.get(site, []):
+            if window.covers(start, end, period):
+                return window
+        return None
+
+    def covers(self, site: str, start: datetime, end: datetime, period: int) -> bool:
+        """ True if the store can serve [start, end) at period for site. """
+        return (
+            self._find(site, _epoch_seconds(start), _epoch_seconds(end), period)
+            is not None
+        )
+
+    def sessions(
+        self, site: str, start: datetime, end: datetime, period: int
+    ) -> pd.DataFrame:
+        """Sessions arriving in [start, end), with times in timesteps from start.
+
+        Args:
+            site (str): Site of the sessions.
+            start (datetime): Timezone aware start of the window.
+            end (datetime): Timezone aware end of the window.
+            period (int): Length of each timestep. [min]
+
+        Returns:
+            pd.DataFrame: One row per session with columns SESSION_COLUMNS.
+        """
+        start, end = _epoch_seconds(start), _epoch_seconds(end)
+        window = self._find(site, start, end, period)
+        if window is None:
+            raise KeyError(f"No events stored for {site} covering the window.")
+        sessions = window.slice(start, end).copy()
+        # Floor division is exact here: window times are the start of their period
+        # on a grid aligned with start, and period is a multiple of that grid.
+        step = period * 60
+        for column in ("arrival", "departure", "estimated_departure"):
+            sessions[column] = (sessions[column] - start) // step
+        return sessions
+
+    def events(
+        self,
+        site: str,
+        start: datetime,
+        end: datetime,
+        period: int,
+        max_battery_power: float,
+    ) -> acnsim.EventQueue:
+        """Events queue for [start, end), as generate_events would return it.
+
+        Args:
+            site (str): Site of the sessions.
+            start (datetime): Timezone aware start of the window.
+            end (datetime): Timezone aware end of the window.
+            period (int): Length of each timestep. [min]
+            max_battery_power (float): Maximum power of each EV's battery. [kW]
+
+        Returns:
+            acnsim.EventQueue: One plugin event per session.
+        """
+        sessions = self.sessions(site, start, end, period)
+        events = []
+        for s in sessions.itertuples(index=False):
+            battery = acnsim.Battery(s.requested_energy, 0, max_battery_power)
+            ev = acnsim.EV(
+                int(s.arrival),
+                int(s.departure),
+                s.requested_energy,
+                s.station_id,
+                s.session_id,
+                battery,
+                int(s.estimated_departure),
+            )
+            events.append(acnsim.PluginEvent(int(s.arrival), ev))
+        return acnsim.EventQueue(events)
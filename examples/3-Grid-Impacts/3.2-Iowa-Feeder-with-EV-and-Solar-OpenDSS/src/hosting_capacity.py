@@ -0,0 +1,256 @@
+# coding=utf-8
+"""
+Hosting-capacity search for added load or generation on the Iowa feeder.
+"""
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import opendssdirect as dss
+import pandas as pd
+from tqdm import tqdm
+
+# noinspection PyUnresolvedReferences
+from opendss_experiment import OpenDSSExperiment
+
+# Columns of the capacity table.
+CAPACITY_COLUMNS = (
+    "capacity",
+    "upper",
+    "capacity_kw",
+    "limiting_time",
+    "reason",
+    "candidates",
+    "solves",
+    "full_runs",
+)
+
+
+def bus_targets(buses: Sequence[str], unbalanced: bool = False):
+    """OpenDSS load names of each bus, named as by ACNOpenDSSCompositeExperiment.
+
+    Returns:
+        Dict[str, List[str]]: Load names of each bus, to pass to
+            HostingCapacitySearch.run.
+    """
+    if unbalanced:
+        return {bus: [f"load_{bus}_{p}" for p in "abc"] for bus in buses}
+    return {bus: [f"load_{bus}"] for bus in buses}
+
+
+class HostingCapacitySearch:
+    """Bisects the multiplier of an added load or generation profile at each target
+    (a bus, or the whole feeder) up to the first voltage or overload violation.
+
+    All candidates are solved on the compiled circuit of one experiment; only the
+    kW and kvar of the target loads change between them. Each candidate stops at its
+    first violating step, and steps whose added power is zero are never solved.
+    Violations are assumed monotone in the multiplier, so a step found safe at m is
+    skipped for every later candidate below m, and the last violating step is solved
+    first. Violations already present without any added power (found by one
+    baseline run) are not counted.
+
+    The experiment's results are overwritten by the candidates, so run it again
+    afterwards if its own results are needed.
+
+    Args:
+        experiment (OpenDSSExperiment): Feeder to search, with any other added
+            loads already applied. Its circuit is kept compiled during the search,
+            and carry_taps must be False so steps can be solved in any order.
+        v_min (float): Lowest allowed node voltage. [pu]
+        v_max (float): Highest allowed node voltage. [pu]
+        loading_limit (float): Highest allowed loading of each power delivery
+            element, or None to only check voltages. [% of normal rating]
+        tolerance (float): Bisection stops when the bracket is narrower than this
+            share of its upper end.
+        initial (float): First multiplier tried. The bracket is found by doubling
+            it.
+        max_multiplier (float): Largest multiplier tried.
+    """
+
+    def __init__(
+        self,
+        experiment: OpenDSSExperiment,
+        v_min: float = 0.95,
+        v_max: float = 1.05,
+        loading_limit: Optional[float] = 100,
+        tolerance: float = 0.01,
+        initial: float = 1.0,
+        max_multiplier: float = 64.0,
+    ):
+        if experiment.carry_taps:
+            raise ValueError(
+                "Hosting-capacity search solves steps out of order, which requires "
+                "carry_taps=False."
+            )
+        self.experiment = experiment
+        self.v_min = v_min
+        self.v_max = v_max
+        self.loading_limit = loading_limit
+        self.tolerance = tolerance
+        self.initial = initial
+        self.max_multiplier = max_multiplier
+        self.steps = experiment.horizon // experiment.period
+        self.solves = 0
+        self._families = frozenset()
+        self._base_kw = self._base_kvar = None
+        # Nodes and elements in violation at baseline, only for steps with any.
+        self._baseline = {}
+
+    def _violation(self, t: int) -> Optional[str]:
+        """ Reason step t of the last solve violates a limit, or None. """
+        if not dss.Solution.Converged():
+            return "not converged"
+        results = self.experiment.results
+        known_nodes, known_elements = self._baseline.get(t, (None, None))
+        voltages = results.voltages[t]
+        for reason, bad in (
+            ("undervoltage", (voltages > 0) & (voltages < self.v_min)),
+            ("overvoltage", voltages > self.v_max),
+        ):
+            if known_nodes is not None:
+                bad &= ~known_nodes
+            if bad.any():
+                return reason
+        if self.loading_limit is not None:
+            bad = results.capacity[1, t] > self.loading_limit
+            if known_elements is not None:
+                bad &= ~known_elements
+            if bad.any():
+                return "overload"
+        return None
+
+    def _solve(self, t: int):
+        self.experiment.solve_step(t, self._families)
+        self.solves += 1
+
+    def _start(self):
+        """ Compile the circuit and record the violations present at baseline. """
+        experiment = self.experiment
+        experiment.persistent_circuit = True
+        families = ["capacity"] if self.loading_limit is not None else False
+        self._families = frozenset(experiment.start_run(families))
+        self._base_kw = experiment._load_kw.copy()
+        self._base_kvar = experiment._load_kvar.copy()
+        self._baseline = {}
+        results = experiment.results
+        for t in tqdm(range(self.steps), desc="baseline"):
+            self._solve(t)
+            voltages = results.voltages[t]
+            nodes = ((voltages > 0) & (voltages < self.v_min)) | (voltages > self.v_max)
+            elements = None
+            if self.loading_limit is not None:
+                elements = results.capacity[1, t] > self.loading_limit
+            if nodes.any() or (elements is not None and elements.any()):
+                self._baseline[t] = (nodes, elements)
+
+    def _set_multiplier(self, columns: List[int], unit: np.ndarray, multiplier):
+        """ Set the target loads to baseline plus multiplier times unit. """
+        experiment = self.experiment
+        experiment._load_kw[:, columns] = (
+            self._base_kw[:, columns] + multiplier * unit.real[:, np.newaxis]
+        )
+        experiment._load_kvar[:, columns] = (
+            self._base_kvar[:, columns] + multiplier * unit.imag[:, np.newaxis]
+        )
+
+    def _search(self, columns: List[int], unit: np.ndarray) -> Dict:
+        """ Bisect the multiplier of unit at the loads in columns. """
+        active = np.flatnonzero(np.abs(unit) > 0)
+        # Steps with the most added power are the most likely to violate first.
+        order = list(active[np.argsort(-np.abs(unit[active]), kind="stable")])
+        safe_at = np.zeros(self.steps)
+        solves = self.solves
+
+        def violation(multiplier):
+            self._set_multiplier(columns, unit, multiplier)
+            for t in order:
+                if safe_at[t] >= multiplier:
+                    continue
+                self._solve(t)
+                reason = self._violation(t)
+                if reason is not None:
+                    order.remove(t)
+                    order.insert(0, t)
+                    return t, reason
+                safe_at[t] = multiplier
+            return None
+
+        lo, hi, limit, candidates = 0.0, np.inf, None, 0
+        multiplier = self.initial
+        while np.isinf(hi):
+            candidates += 1
+            found = violation(multiplier)
+            if found is None:
+                lo = multiplier
+                if multiplier >= self.max_multiplier:
+                    break
+                multiplier = min(2 * multiplier, self.max_multiplier)
+            else:
+                hi, limit = multiplier, found
+        while hi - lo > self.tolerance * hi:
+            candidates += 1
+            multiplier = (lo + hi) / 2
+            found = violation(multiplier)
+            if found is None:
+                lo = multiplier
+            else:
+                hi, limit = multiplier, found
+        self._set_multiplier(columns, unit, 0)
+        solves = self.solves - solves
+        return {
+            "capacity": lo,
+            "upper": hi,
+            "capacity_kw": lo * len(columns) * np.abs(unit.real).max(initial=0),
+            "limiting_time": (
+                self.experiment.results.times[limit[0]] if limit else pd.NaT
+            ),
+            "reason": limit[1] if limit else "max_multiplier",
+            "candidates": candidates,
+            "solves": solves,
+            "full_runs": solves / self.steps,
+        }
+
+    def run(self, targets: Dict[str, Sequence[str]], profile, offset: int = 0):
+        """Find the hosting capacity of each target.
+
+        Targets are searched one at a time, with the others at their baseline. To
+        search the whole feeder at once, pass a single target holding every load,
+        e.g. {"feeder": experiment._load_names}.
+
+        Args:
+            targets (Dict[str, Sequence[str]]): OpenDSS load names of each target,
+                e.g. from bus_targets.
+            profile (np.ndarray): Power added to each load of a target at
+                multiplier 1, at each step of the source signal. Negative values
+                serve as generation. [kW + j kvar]
+            offset (int): Index into profile of the first step of the experiment.
+
+        Returns:
+            pd.DataFrame: One row per target, with columns CAPACITY_COLUMNS.
+                capacity is the largest multiplier found safe and upper the
+                smallest found to violate (inf if none up to max_multiplier).
+                capacity_kw is the peak added real power at capacity, over all
+                loads of the target.
+        """
+        experiment = self.experiment
+        unknown = {
+            name
+            for names in targets.values()
+            for name in names
+            if name not in experiment._load_index
+        }
+        if unknown:
+            raise ValueError(f"Unknown loads {sorted(unknown)}.")
+        unit = np.zeros(self.steps, dtype=complex)
+        values = np.asarray(profile)[offset : offset + self.steps]
+        unit[: len(values)] = values
+        persistent_circuit = experiment.persistent_circuit
+        try:
+            self._start()
+            rows = {}
+            for target, names in tqdm(targets.items(), desc="targets"):
+                columns = sorted({experiment._load_index[name] for name in names})
+                rows[target] = self._search(columns, unit)
+        finally:
+            experiment.persistent_circuit = persistent_circuit
+        return pd.DataFrame.from_dict(rows, orient="index", columns=CAPACITY_COLUMNS)
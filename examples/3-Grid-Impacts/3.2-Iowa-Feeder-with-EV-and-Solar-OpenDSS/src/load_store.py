@@ -0,0 +1,132 @@
+# coding=utf-8
+"""
+Memory-mapped nodal load data with cheap window selection and resampling.
+"""
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Largest number of loaded windows kept. The least recently used is evicted first.
+MAX_WINDOWS = 8
+
+# Open stores by path prefix, and loaded windows by (prefix, start, end, period).
+_stores: Dict[str, "NodalLoads"] = {}
+_windows: "OrderedDict[Tuple, pd.DataFrame]" = OrderedDict()
+
+
+class NodalLoads:
+    """Load of each node at each time, stored as a NumPy array on disk.
+
+    The first time a csv file is opened it is converted to a .npy array of values,
+    a .npy array of timestamps and a json file of column names, next to the csv
+    (and ignored by git).
+    After that, only the rows of a requested window are read from disk.
+
+    Args:
+        prefix (str): Path of the csv file without its extension, e.g.
+            iowa_data/iowa_nodal_P.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        if self.stale():
+            self.convert()
+        self.values = np.load(f"{prefix}.npy", mmap_mode="r")
+        with open(f"{prefix}_meta.json") as f:
+            meta = json.load(f)
+        self.columns = pd.Index(meta["columns"])
+        self.index = pd.DatetimeIndex(np.load(f"{prefix}_index.npy"))
+        if meta["tz"] is not None:
+            self.index = self.index.tz_localize("UTC").tz_convert(meta["tz"])
+
+    def stale(self) -> bool:
+        """ True if the binary files are missing or older than the csv file. """
+        csv_path = f"{self.prefix}.csv"
+        paths = [f"{self.prefix}{s}" for s in (".npy", "_index.npy", "_meta.json")]
+        if not all(os.path.exists(path) for path in paths):
+            return True
+        if not os.path.exists(csv_path):
+            return False
+        return os.path.getmtime(csv_path) > min(os.path.getmtime(p) for p in paths)
+
+    def convert(self):
+        """ Convert the csv file to the binary files read by the store. """
+        df = pd.read_csv(f"{self.prefix}.csv", parse_dates=True, index_col=0)
+        df = df.sort_index()
+        index = df.index
+        tz = None if index.tz is None else str(index.tz)
+        if tz is not None:
+            index = index.tz_convert("UTC").tz_localize(None)
+        np.save(f"{self.prefix}.npy", df.to_numpy(dtype=np.float64))
+        np.save(f"{self.prefix}_index.npy", index.to_numpy(dtype="datetime64[ns]"))
+        with open(f"{self.prefix}_meta.json", "w") as f:
+            json.dump({"columns": [str(c) for c in df.columns], "tz": tz}, f)
+
+    def window(self, start: datetime, end: datetime, period: int) -> pd.DataFrame:
+        """Loads from start to end (inclusive), resampled to period.
+
+        Equivalent to df[start:end].resample(f"{period}T").bfill() on the csv
+        data, computed with binary searches on the time index.
+
+        Args:
+            start (datetime): First time of the window.
+            end (datetime): Last time of the window.
+            period (int): Resampling period. [min]
+
+        Returns:
+            pd.DataFrame: Load of each node (columns) at each time (rows).
+        """
+        lo = self.index.searchsorted(start, side="left")
+        hi = self.index.searchsorted(end, side="right")
+        index = self.index[lo:hi]
+        if len(index) == 0:
+            return pd.DataFrame(columns=self.columns, index=index, dtype=np.float64)
+        # Bins are anchored at midnight of the first day, like pandas' resample.
+        freq = pd.Timedelta(minutes=period)
+        origin = index[0].normalize()
+        labels = pd.date_range(
+            origin + (index[0] - origin) // freq * freq,
+            origin + (index[-1] - origin) // freq * freq,
+            freq=freq,
+        )
+        # Back fill: each label takes the first sample at or after it.
+        rows = lo + index.searchsorted(labels, side="left")
+        values = np.array(self.values[rows])
+        return pd.DataFrame(values, index=labels, columns=self.columns)
+
+
+def load_window(prefix: str, start: datetime, end: datetime, period: int):
+    """Nodal loads from start to end (inclusive), resampled to period.
+
+    The last MAX_WINDOWS windows are cached in process, keyed by (prefix, start,
+    end, period). A copy is returned each time, so callers may modify it.
+
+    Args:
+        prefix (str): Path of the csv file without its extension.
+        start (datetime): First time of the window.
+        end (datetime): Last time of the window.
+        period (int): Resampling period. [min]
+
+    Returns:
+        pd.DataFrame: Load of each node (columns) at each time (rows).
+    """
+    key = (prefix, start, end, period)
+    if key not in _windows:
+        if prefix not in _stores:
+            _stores[prefix] = NodalLoads(prefix)
+        _windows[key] = _stores[prefix].window(start, end, period)
+        while len(_windows) > MAX_WINDOWS:
+            _windows.popitem(last=False)
+    _windows.move_to_end(key)
+    return _windows[key].copy()
+
+
+def clear_windows():
+    """ Drop every cached window and close the open stores. """
+    _windows.clear()
+    _stores.clear()
@@ -1,16 +1,27 @@
+import copy
+import hashlib
 from datetime import timedelta
 import opendssdirect as dss
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
-from collections import defaultdict
 from tqdm import tqdm
 import os
 import tempfile
 
+# noinspection PyUnresolvedReferences
+from load_store import load_window
+
+# noinspection PyUnresolvedReferences
+from profiling import StageTimer
+
+# noinspection PyUnresolvedReferences
+from results import OpenDSSResults, METRIC_FAMILIES
+
 # TODO: Generalize (maybe as inputs to Constructor?).
 CIRCUIT_DIR = "iowa_dist_feeder"
 LOAD_DIR = "iowa_data"
+REGULATORS = tuple(f"sub_regulator_{p}" for p in "abc")
 
 
 def export_to_df(measurement: str):
@@ -20,23 +31,121 @@ def export_to_df(measurement: str):
         return pd.read_csv(saved_file, index_col=0)
 
 
+def metric_families(detailed_metrics):
+    """Resolve the detailed_metrics argument of OpenDSSExperiment.run to a set.
+
+    Args:
+        detailed_metrics (Union[bool, Iterable[str]]): True for every family in
+            METRIC_FAMILIES, False for none, or an iterable of family names.
+
+    Returns:
+        Set[str]: Selected metric families.
+    """
+    if detailed_metrics is True:
+        return set(METRIC_FAMILIES)
+    if not detailed_metrics:
+        return set()
+    families = set(detailed_metrics)
+    unknown = families - set(METRIC_FAMILIES)
+    if unknown:
+        raise ValueError(
+            f"Unknown metric families {sorted(unknown)}. "
+            f"Options are {METRIC_FAMILIES}."
+        )
+    return families
+
+
+def current_channels():
+    """ Name of each conductor of each terminal of each power delivery element. """
+    channels = []
+    for name, terminals, conductors in zip(
+        dss.PDElements.AllNames(),
+        dss.PDElements.AllNumTerminals(),
+        dss.PDElements.AllNumConductors(),
+    ):
+        for terminal in range(1, terminals + 1):
+            for conductor in range(1, conductors + 1):
+                channels.append(f"{name}.{terminal}.{conductor}")
+    return channels
+
+
 class OpenDSSExperiment:
-    """ Simple class to contain a single experiment. """
+    """Simple class to contain a single experiment.
 
-    def __init__(self, start, horizon, period, reg_control=True):
+    Args:
+        start (datetime): Time to start the experiment.
+        horizon (int): Length of the experiment. [min]
+        period (int): Length of each interval of the experiment. [min]
+        reg_control (bool): If True, include the substation tap changer controls.
+        persistent_circuit (bool): If True, compile the circuit once per run and
+            reset the loads to their baseline values each step instead of
+            rebuilding the circuit from the .dss files every step.
+        carry_taps (bool): Only used with persistent_circuit. If True, regulator
+            taps (and the previous solution) carry over from one step to the next.
+            If False, taps, regulator controls and the solution are reset each
+            step, which approximates the rebuild path to within solver tolerance
+            (benchmarks/compare_persistent.py measures the difference).
+        voltage_dtype (np.dtype): Floating point type used to store node voltages.
+        profile (Union[bool, str]): If True, record the wall time of each stage of
+            the run in self.timer (see StageTimer). If "trace", also keep every
+            call, so the run can be written with self.timer.to_chrome_trace.
+        solution_cache (SolutionCache): If given, run reuses the results of steps
+            whose loads and regulator taps match a step already solved (or are
+            within its tolerance of the last solve) instead of solving them
+            again. See solution_cache.stats() for the hit rate and error bounds.
+            Entries are keyed by circuit_key, so a cache may be shared by
+            experiments on different circuits.
+
+    Attributes:
+        circuit_key (bytes): Digest of the circuit files, reg_control and the names
+            of the loads, nodes and regulators, identifying the compiled circuit in
+            the solution cache.
+    """
+
+    def __init__(
+        self,
+        start,
+        horizon,
+        period,
+        reg_control=True,
+        persistent_circuit=False,
+        carry_taps=False,
+        voltage_dtype=np.float64,
+        profile=False,
+        solution_cache=None,
+    ):
         self.start = start
         self.horizon = horizon  # minutes
         self.period = period  # minutes
         self.end = self.start + timedelta(minutes=horizon)
         self.reg_control = reg_control
-        self.P, self.Q = self.get_load_data()
+        self.persistent_circuit = persistent_circuit
+        self.carry_taps = carry_taps
+        self.timer = StageTimer.from_profile(profile)
+        self.solution_cache = solution_cache
+        with self.timer.stage("get_load_data"):
+            self.P, self.Q = self.get_load_data()
 
         self.build_circuit()
+        self._load_names, self._base_kw, self._base_kvar = self.snapshot_loads()
+        self._load_index = {name: i for i, name in enumerate(self._load_names)}
+        self._base_taps = self.snapshot_taps()
+        self._base_tap_values = np.array(
+            [tap for _, taps in self._base_taps.values() for tap in taps]
+        )
+        # Per-step kW/kvar of every load, aligned with self._load_names.
+        self._load_kw = None
+        self._load_kvar = None
 
         # Information Storage Variables
-        self.voltage_pu = pd.DataFrame(index=dss.Circuit.AllNodeNames())
-        self._taps_dict = defaultdict(dict)
-        self._wdg_dict = defaultdict(dict)
+        self.results = OpenDSSResults(
+            self.P.index[: self.horizon // self.period],
+            dss.Circuit.AllNodeNames(),
+            [n for n in dss.Transformers.AllNames() if n in REGULATORS],
+            voltage_dtype=voltage_dtype,
+        )
+
+        self.circuit_key = self._circuit_key()
 
         self._summary_dict = dict()
         self._overload_dict = dict()
@@ -44,24 +153,37 @@ class OpenDSSExperiment:
         self._currents_dict = dict()
         self._profile_dict = dict()
 
+    @property
+    def voltage_pu(self):
+        return self.results.voltage_pu()
+
+    @property
+    def summary(self):
+        return self.results.summary_df()
+
+    @property
+    def overload(self):
+        return self.results.overload_df()
+
     @property
     def wdg(self):
-        return pd.DataFrame(self._wdg_dict)
+        return self.results.wdg_df()
 
     @property
     def taps(self):
-        return pd.DataFrame(self._taps_dict)
+        return self.results.tap_df()
 
     def get_load_data(self):
-        """ Get baseline load data from csv files. """
-        loads = {}
-        for pq in "PQ":
-            loads[pq] = pd.read_csv(
-                f"{LOAD_DIR}/iowa_nodal_{pq}.csv", parse_dates=True, index_col=0
-            )
-            loads[pq] = loads[pq][self.start : self.end + timedelta(hours=1)]
-            loads[pq] = loads[pq].resample(f"{self.period}T").bfill()
-        return loads["P"], loads["Q"]
+        """Get baseline load data from the memory-mapped load store.
+
+        The csv files are converted to binary arrays on first use, and each window
+        is cached in process, so repeated experiments do not parse the csv again.
+        """
+        end = self.end + timedelta(hours=1)
+        return tuple(
+            load_window(f"{LOAD_DIR}/iowa_nodal_{pq}", self.start, end, self.period)
+            for pq in "PQ"
+        )
 
     def build_circuit(self):
         """ Set up the Iowa test circuit in OpenDSS. """
@@ -87,75 +209,377 @@ class OpenDSSExperiment:
         dss.run_command('Set VoltageBases = "69.0, 13.8, 0.208"')
         dss.run_command("CalcVoltageBases")
 
+    def _circuit_key(self):
+        """ Digest of the compiled circuit's source, controls, loads and nodes. """
+        h = hashlib.blake2b(digest_size=16)
+        for part in (
+            CIRCUIT_DIR,
+            str(self.reg_control),
+            *self._load_names,
+            *self.results.node_names,
+            *self.results.regulator_names,
+        ):
+            h.update(part.encode())
+            h.update(b"\0")
+        return h.digest()
+
+    def snapshot_loads(self):
+        """Record the baseline kW and kvar of each load in the compiled circuit.
+
+        Returns:
+            Tuple[List[str], np.ndarray, np.ndarray]: Load names in OpenDSS order and
+                the baseline kW and kvar of each load.
+        """
+        names, kw, kvar = [], [], []
+        for load_name in dss.utils.Iterator(dss.Loads, "Name"):
+            names.append(load_name())
+            kw.append(dss.Loads.kW())
+            kvar.append(dss.Loads.kvar())
+        return names, np.array(kw), np.array(kvar)
+
+    def snapshot_taps(self):
+        """ Record the tap of each winding and the active winding of each regulator. """
+        taps = {}
+        for name in dss.utils.Iterator(dss.Transformers, "Name"):
+            if name() in REGULATORS:
+                active_wdg = dss.Transformers.Wdg()
+                winding_taps = []
+                for wdg in range(1, dss.Transformers.NumWindings() + 1):
+                    dss.Transformers.Wdg(wdg)
+                    winding_taps.append(dss.Transformers.Tap())
+                dss.Transformers.Wdg(active_wdg)
+                taps[name()] = (active_wdg, winding_taps)
+        return taps
+
+    def regulator_taps(self):
+        """ Tap of each winding of each regulator, in the order of _base_taps. """
+        taps = []
+        for name in self._base_taps:
+            dss.Transformers.Name(name)
+            active_wdg = dss.Transformers.Wdg()
+            for wdg in range(1, dss.Transformers.NumWindings() + 1):
+                dss.Transformers.Wdg(wdg)
+                taps.append(dss.Transformers.Tap())
+            dss.Transformers.Wdg(active_wdg)
+        return np.array(taps)
+
+    def set_regulator_taps(self, taps):
+        """ Set the tap of each winding of each regulator, as from regulator_taps. """
+        taps = iter(taps)
+        for name, (active_wdg, winding_taps) in self._base_taps.items():
+            dss.Transformers.Name(name)
+            for wdg in range(1, len(winding_taps) + 1):
+                dss.Transformers.Wdg(wdg)
+                dss.Transformers.Tap(next(taps))
+            dss.Transformers.Wdg(active_wdg)
+
+    def reset_circuit(self):
+        """Return a compiled circuit to (close to) the state of a freshly built one.
+
+        Loads are reset to their baseline in step_loads. Unless carry_taps is set,
+        regulator taps are restored, control elements (e.g. RegControl delays and
+        pending actions) are reset and the no-load solution is recomputed, as at the
+        end of build_circuit. Other solver state is kept, so results can differ from
+        a rebuild within the solver's tolerance.
+        """
+        if self.carry_taps:
+            return
+        for name, (active_wdg, winding_taps) in self._base_taps.items():
+            dss.Transformers.Name(name)
+            for wdg, tap in enumerate(winding_taps, start=1):
+                dss.Transformers.Wdg(wdg)
+                dss.Transformers.Tap(tap)
+            dss.Transformers.Wdg(active_wdg)
+        dss.run_command("Reset Controls")
+        dss.run_command("CalcVoltageBases")
+
+    def subset_steps(self, first, last):
+        """Copy of the experiment covering only steps [first, last).
+
+        The copy shares the compiled-circuit snapshots but has its own load data
+        and an empty result store sized for the subset, so it is cheap to send to
+        another process.
+
+        Args:
+            first (int): First step of the subset.
+            last (int): Step after the last step of the subset.
+
+        Returns:
+            OpenDSSExperiment
+        """
+        subset = copy.copy(self)
+        subset.P = self.P.iloc[first:last].copy()
+        subset.Q = self.Q.iloc[first:last].copy()
+        subset.start = self.P.index[first]
+        subset.horizon = (last - first) * self.period
+        subset.end = subset.start + timedelta(minutes=subset.horizon)
+        subset._load_kw = subset._load_kvar = None
+        subset.results = OpenDSSResults(
+            self.results.times[first:last],
+            self.results.node_names,
+            self.results.regulator_names,
+            voltage_dtype=self.results.voltages.dtype,
+        )
+        for family in METRIC_FAMILIES:
+            setattr(subset, f"_{family}_dict", dict())
+        return subset
+
     def add_load(self, acn_buses, ev_load, ev_load_offset=0):
         """ Add additional load to the baseline load. If negative, this can serve as generation. """
-        for acn_bus in acn_buses:
-            load = ev_load[
-                ev_load_offset : ev_load_offset + self.horizon // self.period
-            ]
-            if acn_bus not in self.P:
-                self.P[acn_bus] = np.zeros(self.P.shape[0])
-            bus_index = self.P.columns.get_loc(acn_bus)
-            self.P.iloc[: self.horizon // self.period, bus_index] += np.real(load)
+        ev_load = np.asarray(ev_load)
+        self.add_loads(
+            list(acn_buses),
+            np.broadcast_to(ev_load, (len(acn_buses), len(ev_load))),
+            ev_load_offset,
+        )
+
+    def add_loads(self, load_names, loads, offset=0, first_step=0):
+        """Add additional load to the baseline of many loads at once.
 
-            if acn_bus not in self.Q:
-                self.Q[acn_bus] = np.zeros(self.Q.shape[0])
-            bus_index = self.Q.columns.get_loc(acn_bus)
-            self.Q.iloc[: self.horizon // self.period, bus_index] += np.imag(load)
+        Missing columns are added to P and Q with a single concat, and the loads
+        are added with one vectorized update of each. If the per-step loads have
+        already been aligned, they are updated in place rather than recomputed, so
+        loads can be added one step at a time during a run.
+
+        Args:
+            load_names (List[str]): Name of the load for each row of loads. Rows
+                with the same name are summed.
+            loads (np.ndarray): Complex power of each load at each step of the
+                source signal. (loads x T) [kW + j kvar] Negative values can serve
+                as generation.
+            offset (int): Index into the source signal of the first step of the
+                experiment.
+            first_step (int): Step of the experiment at which to start adding.
+        """
+        steps = self.horizon // self.period - first_step
+        loads = np.asarray(loads)[:, offset : offset + steps]
+        rows = slice(first_step, first_step + loads.shape[1])
+        names, index = np.unique(load_names, return_inverse=True)
+        summed = np.zeros((len(names), loads.shape[1]), dtype=complex)
+        np.add.at(summed, index, loads)
+        realign = False
+        for attr, values in (("P", summed.real), ("Q", summed.imag)):
+            df = getattr(self, attr)
+            missing = [name for name in names if name not in df]
+            if missing:
+                # Aligned loads ignore the baseline of loads missing from P and Q.
+                realign |= any(name in self._load_index for name in missing)
+                zeros = pd.DataFrame(0.0, index=df.index, columns=missing)
+                df = pd.concat([df, zeros], axis=1)
+            columns = df.columns.get_indexer(names)
+            df.iloc[rows, columns] = df.iloc[rows, columns].to_numpy() + values.T
+            setattr(self, attr, df)
+        if self._load_kw is None or realign:
+            self._load_kw = self._load_kvar = None
+            return
+        present = [i for i, name in enumerate(names) if name in self._load_index]
+        columns = [self._load_index[names[i]] for i in present]
+        self._load_kw[rows, columns] += summed.real[present].T
+        self._load_kvar[rows, columns] += summed.imag[present].T
+
+    def align_loads(self):
+        """Pre-compute the kW and kvar of every load at every step.
+
+        Columns of P and Q are aligned with the OpenDSS load list and added to the
+        baseline of each load. Loads missing from P (or Q) are zeroed.
+        """
+        steps = self.horizon // self.period
+        aligned = []
+        for df, base in ((self.P, self._base_kw), (self.Q, self._base_kvar)):
+            values = np.zeros((steps, len(self._load_names)))
+            present = [i for i, name in enumerate(self._load_names) if name in df]
+            columns = [self._load_names[i] for i in present]
+            values[:, present] = df[columns].to_numpy()[:steps] + base[present]
+            aligned.append(values)
+        self._load_kw, self._load_kvar = aligned
 
     def step_loads(self, t):
-        """ Update loads within the OpenDSS model using the dataframes P and Q. """
-        for load_name in dss.utils.Iterator(dss.Loads, "Name"):
-            name = load_name()
-            if name in self.P:
-                dss.Loads.kW(dss.Loads.kW() + self.P[name][t])
-            else:
-                dss.Loads.kW(0)
-
-            if name in self.Q:
-                dss.Loads.kvar(dss.Loads.kvar() + self.Q[name][t])
-            else:
-                dss.Loads.kvar(0)
-
-    def store_voltages(self, time):
-        """ Store per unit voltage for each node. """
-        names = []
-        volts = []
-        for name in dss.Circuit.AllBusNames():
-            # Set the Active bus
-            dss.Circuit.SetActiveBus(name)
-            # Compute the voltage
-            voltages = [
-                abs(complex(i[0], i[1])) for i in zip(*[iter(dss.Bus.PuVoltage())] * 2)
-            ]
-            for i, node in enumerate(dss.Bus.Nodes()):
-                names.append(f"{name}.{node}")
-                volts.append(voltages[i])
-        self.voltage_pu[time] = pd.Series(volts, names)
+        """Update loads within the OpenDSS model using the dataframes P and Q.
+
+        Loads are set relative to their baseline values, so this works both on a
+        freshly built circuit and on a persistent one.
+        """
+        if self._load_kw is None:
+            self.align_loads()
+        kw = self._load_kw[t].tolist()
+        kvar = self._load_kvar[t].tolist()
+        i = 0
+        more = dss.Loads.First()
+        while more:
+            dss.Loads.kW(kw[i])
+            dss.Loads.kvar(kvar[i])
+            i += 1
+            more = dss.Loads.Next()
+
+    def store_voltages(self, t):
+        """Store per unit voltage for each node.
 
-    def store_transformer_info(self, time):
+        AllBusMagPu returns one magnitude per node, in the same order as
+        AllNodeNames, so the whole circuit is read with a single call.
+        """
+        self.results.store_voltages(t, dss.Circuit.AllBusMagPu())
+
+    def store_transformer_info(self, t):
         """ Store winding and tap position for transformer. """
-        for name in dss.utils.Iterator(dss.Transformers, "Name"):
-            if name() in set(f"sub_regulator_{p}" for p in "abc"):
-                self._taps_dict[time][name()] = dss.Transformers.Tap()
-                self._wdg_dict[time][name()] = dss.Transformers.Wdg()
+        taps, wdg = [], []
+        for name in self.results.regulator_names:
+            dss.Transformers.Name(name)
+            taps.append(dss.Transformers.Tap())
+            wdg.append(dss.Transformers.Wdg())
+        self.results.store_regulators(t, taps, wdg)
 
-    def run(self, detailed_metrics=True):
-        """ Run the experiment. """
-        steps = self.horizon // self.period
-        for t in tqdm(range(steps)):
-            self.build_circuit()
+    def allocate_metrics(self, families):
+        """ Allocate result storage for the selected detailed metric families. """
+        needs_elements = families & {"capacity", "overload"}
+        self.results.allocate_metrics(
+            families,
+            element_names=dss.PDElements.AllNames() if needs_elements else None,
+            current_channels=current_channels() if "currents" in families else None,
+            node_distances=(
+                dss.Circuit.AllNodeDistances() if "profile" in families else None
+            ),
+        )
+
+    def store_metrics(self, t, families):
+        """Store detailed metrics read directly from the in-memory element APIs.
+
+        The profile family only needs node distances, which are static and stored
+        by allocate_metrics; voltages are already stored by store_voltages.
+        """
+        summary = capacity = currents = None
+        if "summary" in families:
+            losses = dss.Circuit.Losses()
+            voltages = self.results.voltages[t]
+            voltages = voltages[voltages > 0]
+            summary = [
+                *dss.Circuit.TotalPower(),
+                losses[0] / 1000,
+                losses[1] / 1000,
+                *dss.Circuit.LineLosses(),
+                *dss.Circuit.SubstationLosses(),
+                voltages.max(),
+                voltages.min(),
+                dss.Solution.Iterations(),
+                dss.Solution.Converged(),
+            ]
+        if families & {"capacity", "overload"}:
+            capacity = (
+                dss.PDElements.AllMaxCurrents(),
+                dss.PDElements.AllPctNorm(),
+                dss.PDElements.AllPctEmerg(),
+            )
+        if "currents" in families:
+            currents = np.asarray(dss.PDElements.AllCurrentsMagAng())[::2]
+        self.results.store_metrics(t, summary, capacity, currents)
+
+    def export_metrics(self, time, families):
+        """ Store detailed metrics by exporting OpenDSS reports to csv files. """
+        for family in families:
+            getattr(self, f"_{family}_dict")[time] = export_to_df(family)
+
+    def start_run(self, detailed_metrics=True, export_files=False):
+        """Prepare to solve steps one at a time with solve_step.
+
+        Args:
+            detailed_metrics (Union[bool, Iterable[str]]): See run.
+            export_files (bool): See run.
+
+        Returns:
+            Set[str]: Selected metric families, to pass to solve_step.
+        """
+        families = metric_families(detailed_metrics)
+        timer = self.timer
+        if self.persistent_circuit:
+            # Other experiments may have used the (global) engine since __init__.
+            with timer.stage("build_circuit"):
+                self.build_circuit()
+        with timer.stage("align_loads"):
+            self.align_loads()
+        if families and not export_files:
+            self.allocate_metrics(families)
+        return families
+
+    def solve_step(self, t, families=frozenset(), export_files=False):
+        """ Set the loads of step t, solve the circuit and store the results. """
+        timer = self.timer
+        if self.persistent_circuit:
+            with timer.stage("reset_circuit"):
+                self.reset_circuit()
+        else:
+            with timer.stage("build_circuit"):
+                self.build_circuit()
+        with timer.stage("step_loads"):
             self.step_loads(t)
+        with timer.stage("solve"):
             dss.run_command("Solve")
-            time = self.P.index[t]
-            self.store_voltages(time)
-            self.store_transformer_info(time)
-            if detailed_metrics:
-                self._summary_dict[time] = export_to_df("summary")
-                self._overload_dict[time] = export_to_df("overload")
-                self._capacity_dict[time] = export_to_df("capacity")
-                self._currents_dict[time] = export_to_df("currents")
-                self._profile_dict[time] = export_to_df("profile")
+        with timer.stage("store_voltages"):
+            self.store_voltages(t)
+        with timer.stage("store_transformer_info"):
+            self.store_transformer_info(t)
+        if families and export_files:
+            with timer.stage("export_metrics"):
+                self.export_metrics(self.P.index[t], families)
+        elif families:
+            with timer.stage("store_metrics"):
+                self.store_metrics(t, families)
+
+    def solve_step_cached(self, t, families=frozenset()):
+        """Solve step t, or reuse the results of a matching step from the solution
+        cache.
+
+        Taps only carry over between steps of a persistent circuit with carry_taps,
+        so otherwise every step starts from the baseline taps. On a hit with
+        carried taps, the regulators are set to the taps after the reused solve.
+        """
+        timer = self.timer
+        cache = self.solution_cache
+        carry = self.persistent_circuit and self.carry_taps
+        with timer.stage("cache_lookup"):
+            if self._load_kw is None:
+                self.align_loads()
+            taps = self.regulator_taps() if carry else self._base_tap_values
+            state = cache.state(
+                self._load_kw[t], self._load_kvar[t], taps, self.circuit_key
+            )
+            keys = self.results.row_keys()
+            if carry:
+                keys.add("regulator_taps")
+            row = cache.lookup(state, keys)
+        if row is not None:
+            with timer.stage("cache_restore"):
+                self.results.store_row(t, row)
+                if carry:
+                    self.set_regulator_taps(row["regulator_taps"])
+            return
+        self.solve_step(t, families)
+        with timer.stage("cache_store"):
+            row = self.results.step_row(t)
+            if carry:
+                row["regulator_taps"] = self.regulator_taps()
+            cache.store(state, row)
+
+    def run(self, detailed_metrics=True, export_files=False):
+        """Run the experiment.
+
+        Args:
+            detailed_metrics (Union[bool, Iterable[str]]): Families of detailed
+                metrics to collect each step. True collects every family in
+                METRIC_FAMILIES, False collects none.
+            export_files (bool): If True, collect detailed metrics by exporting the
+                OpenDSS reports to temporary csv files (stored in the per-step
+                dictionaries, e.g. _overload_dict) instead of reading them from
+                memory into self.results. The solution cache is not used with
+                exported files.
+        """
+        steps = self.horizon // self.period
+        families = self.start_run(detailed_metrics, export_files)
+        if self.solution_cache is None or export_files:
+            for t in tqdm(range(steps)):
+                self.solve_step(t, families, export_files)
+            return
+        self.solution_cache.start()
+        for t in tqdm(range(steps)):
+            self.solve_step_cached(t, families)
 
     def plot_voltage(self, ax=None, legend=False, title=None):
         """ Plot maximum and minimum voltage in the network. """
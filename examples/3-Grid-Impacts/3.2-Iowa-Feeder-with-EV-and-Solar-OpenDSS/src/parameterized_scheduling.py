@@ -0,0 +1,421 @@
+# coding=utf-8
+"""
+Model predictive scheduling with parameterized (DPP) cvxpy problems.
+
+AdaptiveSchedulingAlgorithm builds and canonicalizes a new cvxpy problem at every
+call. Here the problem for each optimization horizon is built once, with every
+quantity which changes between calls (rate bounds, remaining energy, prices, peak
+limits, external signals, demand charge scaling) held in a cp.Parameter, and is
+then re-solved with new parameter values.
+"""
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import cvxpy as cp
+import numpy as np
+from acnportal.algorithms import BaseAlgorithm
+
+
+class ParameterizedComponent(ABC):
+    """A term of the objective of a ParameterizedSchedulingAlgorithm.
+
+    Subclasses build the term once per problem (creating any cvxpy Parameters it
+    needs) and update those parameters before each solve.
+
+    Args:
+        coefficient (float): Weight of the term in the objective.
+    """
+
+    def __init__(self, coefficient: float = 1):
+        self.coefficient = coefficient
+
+    @abstractmethod
+    def build(self, rates, infrastructure, period):
+        """Build the term for a rates variable of a given shape.
+
+        Args:
+            rates (cp.Variable): Charging rates. (stations x horizon) [A]
+            infrastructure (InfrastructureInfo): Description of the network.
+            period (int): Length of each step. [min]
+
+        Returns:
+            Tuple[cp.Expression, Dict[str, cp.Parameter]]: The term (to be
+                maximized) and the parameters it depends on.
+        """
+
+    def update(self, params, interface, infrastructure, horizon):
+        """Set the values of the parameters created by build for this call.
+
+        horizon is the optimization horizon of this call. The problem may have
+        more steps (see ParameterizedSchedulingAlgorithm), so per-step parameters
+        take their length from their own shape; rates beyond horizon are zero.
+        """
+
+
+def aggregate_power(rates, infrastructure):
+    """ Aggregate power at each step. [kW] """
+    return (infrastructure.voltages / 1000) @ rates
+
+
+class TotalEnergy(ParameterizedComponent):
+    """ Total energy delivered over the horizon. [kWh] """
+
+    def build(self, rates, infrastructure, period):
+        return cp.sum(aggregate_power(rates, infrastructure)) * period / 60, {}
+
+
+class TOUEnergyCost(ParameterizedComponent):
+    """ Negative time-of-use energy cost over the horizon. [$] """
+
+    def build(self, rates, infrastructure, period):
+        prices = cp.Parameter(rates.shape[1], name="prices")
+        cost = prices @ aggregate_power(rates, infrastructure) * period / 60
+        return -cost, {"prices": prices}
+
+    def update(self, params, interface, infrastructure, horizon):
+        prices = np.asarray(interface.get_prices(horizon))
+        params["prices"].value = window(prices, 0, params["prices"].shape[0], 0)
+
+
+class DaysRemainingScaleDemandCharge(ParameterizedComponent):
+    """Negative demand charge, divided over the days left in the billing period.
+
+    Args:
+        baseline_peak (float): Peak already expected this billing period. [kW]
+        days_in_month (int): Length of the billing period. [days]
+    """
+
+    def __init__(self, coefficient=1, baseline_peak=0, days_in_month=30):
+        super().__init__(coefficient)
+        self.baseline_peak = baseline_peak
+        self.days_in_month = days_in_month
+
+    def build(self, rates, infrastructure, period):
+        # max(scale * a, scale * b) == scale * max(a, b) for scale >= 0, and keeps
+        # the product of parameters and expressions DPP.
+        scaled_charge = cp.Parameter(nonneg=True, name="scaled_charge")
+        scaled_prev_peak_cost = cp.Parameter(name="scaled_prev_peak_cost")
+        max_power = cp.max(aggregate_power(rates, infrastructure))
+        dc = cp.maximum(scaled_charge * max_power, scaled_prev_peak_cost)
+        return -dc, {
+            "scaled_charge": scaled_charge,
+            "scaled_prev_peak_cost": scaled_prev_peak_cost,
+        }
+
+    def update(self, params, interface, infrastructure, horizon):
+        day_index = interface.current_time // ((60 / interface.period) * 24)
+        day_index = min(day_index, self.days_in_month - 1)
+        scale = 1 / (self.days_in_month - day_index)
+        prev_peak = interface.get_prev_peak() * infrastructure.voltages[0] / 1000
+        prev_peak = max(prev_peak, self.baseline_peak)
+        charge = scale * interface.get_demand_charge()
+        params["scaled_charge"].value = charge
+        params["scaled_prev_peak_cost"].value = charge * prev_peak
+
+
+class QuickCharge(ParameterizedComponent):
+    """Reward for charging earlier in the horizon.
+
+    The weights depend on the horizon of each call, so they are a parameter.
+    """
+
+    def build(self, rates, infrastructure, period):
+        weights = cp.Parameter(rates.shape[1], nonneg=True, name="quick_charge")
+        return weights @ cp.sum(rates, axis=0), {"weights": weights}
+
+    def update(self, params, interface, infrastructure, horizon):
+        steps = np.arange(params["weights"].shape[0])
+        params["weights"].value = np.maximum(horizon - steps, 0) / horizon
+
+
+class EqualShare(ParameterizedComponent):
+    """ Penalty on the squared charging rates, to share capacity equally. """
+
+    def build(self, rates, infrastructure, period):
+        return -cp.sum_squares(rates), {}
+
+
+class LoadFlattening(ParameterizedComponent):
+    """Penalty on the squared total load at the bus.
+
+    Args:
+        external_signal (np.ndarray): Other load at the bus at each step of the
+            simulation. [kW] If None, only the charging load is flattened.
+        scaling_factor (float): Divides the total load before squaring.
+    """
+
+    def __init__(self, coefficient=1, external_signal=None, scaling_factor=1):
+        super().__init__(coefficient)
+        self.external_signal = external_signal
+        self.scaling_factor = scaling_factor
+
+    def build(self, rates, infrastructure, period):
+        total = aggregate_power(rates, infrastructure)
+        params = {}
+        if self.external_signal is not None:
+            params["external"] = cp.Parameter(rates.shape[1], name="external")
+            total = total + params["external"]
+        return -cp.sum_squares(total / self.scaling_factor), params
+
+    def update(self, params, interface, infrastructure, horizon):
+        if self.external_signal is not None:
+            t = interface.current_time
+            size = params["external"].shape[0]
+            params["external"].value = window(self.external_signal, t, size, 0)
+
+
+def window(signal, t, horizon, fill):
+    """ signal[t : t + horizon], padded with fill if signal ends too soon. """
+    values = np.asarray(signal[t : t + horizon], dtype=float)
+    if len(values) < horizon:
+        values = np.concatenate([values, np.full(horizon - len(values), fill)])
+    return values
+
+
+class _CachedProblem:
+    """ A compiled problem for one optimization horizon and its parameters. """
+
+    def __init__(
+        self, objective, infrastructure, period, horizon, constraint_type, peak_limit
+    ):
+        n = len(infrastructure.station_ids)
+        self.rates = cp.Variable((n, horizon), name="rates")
+        self.lb = cp.Parameter((n, horizon), nonneg=True, name="lb")
+        self.ub = cp.Parameter((n, horizon), nonneg=True, name="ub")
+        self.energy = cp.Parameter(n, nonneg=True, name="energy")
+        constraints = [
+            self.rates >= self.lb,
+            self.rates <= self.ub,
+            cp.sum(self.rates, axis=1) <= self.energy,
+        ]
+        constraints.extend(
+            infrastructure_constraints(self.rates, infrastructure, constraint_type)
+        )
+        self.peak = None
+        if peak_limit is not None:
+            self.peak = cp.Parameter(horizon, name="peak")
+            constraints.append(cp.sum(self.rates, axis=0) <= self.peak)
+
+        terms = []
+        self.component_params = []
+        for component in objective:
+            expression, params = component.build(self.rates, infrastructure, period)
+            terms.append(component.coefficient * expression)
+            self.component_params.append(params)
+        self.problem = cp.Problem(cp.Maximize(cp.sum(terms)), constraints)
+        self.solved = False
+
+
+def infrastructure_constraints(rates, infrastructure, constraint_type="SOC"):
+    """Infrastructure constraints with the network's phase angles baked in.
+
+    Args:
+        rates (cp.Variable): Charging rates. (stations x horizon) [A]
+        infrastructure (InfrastructureInfo): Description of the network.
+        constraint_type (str): "SOC" for three-phase magnitude constraints,
+            "LINEAR" for the linear (single-phase) approximation.
+
+    Returns:
+        List[cp.Constraint]: One constraint per infrastructure constraint.
+    """
+    if constraint_type == "LINEAR":
+        limits = infrastructure.constraint_limits.reshape(-1, 1)
+        return [infrastructure.constraint_matrix @ rates <= limits]
+    if constraint_type != "SOC":
+        raise ValueError(
+            f"Unknown constraint type {constraint_type}. Options are SOC and LINEAR."
+        )
+    phases = np.deg2rad(infrastructure.phases)
+    constraints = []
+    for row, limit in zip(
+        infrastructure.constraint_matrix, infrastructure.constraint_limits
+    ):
+        a = np.stack([row * np.cos(phases), row * np.sin(phases)])
+        constraints.append(cp.norm(a @ rates, axis=0) <= limit)
+    return constraints
+
+
+class ParameterizedSchedulingAlgorithm(BaseAlgorithm):
+    """Model predictive control with problems compiled once per horizon bucket.
+
+    Equivalent to adacharge.AdaptiveSchedulingAlgorithm with continuous pilots, but
+    each cvxpy problem is canonicalized only once and re-solved with updated
+    parameters (warm started where the solver supports it).
+
+    The optimization horizon changes almost every call, so it is rounded up to a
+    multiple of horizon_bucket steps and the extra steps are pinned to zero through
+    the rate upper bounds. Problems are keyed on the padded horizon only, not on
+    the set of active EVs: the rates variable covers every station, and stations
+    without an active session are held at zero the same way, so a change in the
+    active EVs only changes parameter values. Both cost idle variables in every
+    solve in exchange for compiling a handful of problems per simulation.
+
+    Args:
+        objective (List[ParameterizedComponent]): Terms of the objective.
+        solver (str): Name of the cvxpy solver to use.
+        peak_limit (Union[float, np.ndarray]): Limit on the aggregate current at
+            each step of the simulation. [A] None for no limit.
+        max_recompute (int): Maximum number of steps between scheduling calls.
+        constraint_type (str): "SOC" or "LINEAR" infrastructure constraints.
+        max_cached_problems (int): Number of compiled problems to keep. The least
+            recently used problem is dropped when the cache is full.
+        horizon_bucket (int): Horizons are padded up to a multiple of this many
+            steps. Set it to the longest horizon to compile a single problem, or to
+            1 to compile one per exact horizon.
+        solver_options (Dict): Other keyword arguments of cp.Problem.solve for the
+            solver, e.g. {"mosek_params": {"MSK_IPAR_NUM_THREADS": 1}}.
+
+    Attributes:
+        solve_stats (List[Dict]): Per call statistics, separating the time spent
+            canonicalizing (compile_time) from the time spent in the solver
+            (solve_time), with the horizon, padded_horizon and whether the problem
+            came from the cache (cache_hit). See cache_summary.
+    """
+
+    def __init__(
+        self,
+        objective: List[ParameterizedComponent],
+        solver: str = "ECOS",
+        peak_limit=None,
+        max_recompute: Optional[int] = None,
+        constraint_type: str = "SOC",
+        max_cached_problems: int = 32,
+        horizon_bucket: int = 12,
+        solver_options: Optional[Dict] = None,
+    ):
+        super().__init__()
+        self.objective = objective
+        self.solver = solver
+        self.peak_limit = peak_limit
+        self.max_recompute = max_recompute
+        self.constraint_type = constraint_type
+        self.max_cached_problems = max_cached_problems
+        self.horizon_bucket = horizon_bucket
+        self.solver_options = dict(solver_options or {})
+        self.solve_stats = []
+        self._problems = OrderedDict()
+
+    def _get_problem(self, infrastructure, horizon):
+        """ Compiled problem for the horizon, and whether it came from the cache. """
+        if horizon in self._problems:
+            self._problems.move_to_end(horizon)
+            return self._problems[horizon], True
+        problem = _CachedProblem(
+            self.objective,
+            infrastructure,
+            self.interface.period,
+            horizon,
+            self.constraint_type,
+            self.peak_limit,
+        )
+        self._problems[horizon] = problem
+        if len(self._problems) > self.max_cached_problems:
+            self._problems.popitem(last=False)
+        return problem, False
+
+    def cache_summary(self) -> Dict[str, float]:
+        """Reuse of compiled problems over the calls so far.
+
+        Returns:
+            Dict[str, float]: calls, compiled (problems built), cache_hits,
+                hit_rate, and total compile_time and solve_time [s] of hits and
+                misses.
+        """
+        stats = self.solve_stats
+        hits = [s for s in stats if s["cache_hit"]]
+        misses = [s for s in stats if not s["cache_hit"]]
+        summary = {
+            "calls": len(stats),
+            "compiled": len(misses),
+            "cache_hits": len(hits),
+            "hit_rate": len(hits) / len(stats) if stats else 0,
+        }
+        for name, calls in (("hit", hits), ("miss", misses)):
+            for field in ("compile_time", "solve_time"):
+                summary[f"{name}_{field}"] = sum(s[field] for s in calls)
+        return summary
+
+    def schedule(self, active_sessions) -> Dict[str, List[float]]:
+        infrastructure = self.interface.infrastructure_info()
+        n = len(infrastructure.station_ids)
+        active_sessions = [
+            s
+            for s in active_sessions
+            if s.remaining_demand > 0 and s.remaining_time > 0
+        ]
+        if len(active_sessions) == 0:
+            return {station_id: [0] for station_id in infrastructure.station_ids}
+        horizon = max(s.arrival_offset + s.remaining_time for s in active_sessions)
+        size = -(-horizon // self.horizon_bucket) * self.horizon_bucket
+        problem, cache_hit = self._get_problem(infrastructure, size)
+
+        # Steps past horizon keep zero bounds, so their rates are pinned to zero.
+        lb, ub, energy = np.zeros((n, size)), np.zeros((n, size)), np.zeros(n)
+        period = self.interface.period
+        for session in active_sessions:
+            i = infrastructure.get_station_index(session.station_id)
+            window_slice = slice(
+                session.arrival_offset, session.arrival_offset + session.remaining_time
+            )
+            lb[i, window_slice] = session.min_rates
+            ub[i, window_slice] = np.minimum(
+                session.max_rates, infrastructure.max_pilot[i]
+            )
+            energy[i] = (
+                session.remaining_demand
+                * 1000
+                * 60
+                / (infrastructure.voltages[i] * period)
+            )
+        # To ensure feasibility, replace upper bound with lower bound when they
+        # conflict.
+        ub = np.maximum(ub, lb)
+        problem.lb.value = lb
+        problem.ub.value = ub
+        problem.energy.value = energy
+        if problem.peak is not None:
+            if np.isscalar(self.peak_limit):
+                problem.peak.value = np.full(size, float(self.peak_limit))
+            else:
+                t = self.interface.current_time
+                problem.peak.value = window(
+                    self.peak_limit, t, size, self.peak_limit[-1]
+                )
+        for component, params in zip(self.objective, problem.component_params):
+            component.update(params, self.interface, infrastructure, horizon)
+
+        start = time.perf_counter()
+        problem.problem.solve(
+            solver=self.solver, warm_start=problem.solved, **self.solver_options
+        )
+        total_time = time.perf_counter() - start
+        problem.solved = True
+        compile_time = problem.problem.compilation_time or 0
+        solve_time = problem.problem.solver_stats.solve_time
+        if solve_time is None:
+            solve_time = total_time - compile_time
+        self.solve_stats.append(
+            {
+                "current_time": self.interface.current_time,
+                "active_sessions": len(active_sessions),
+                "horizon": horizon,
+                "padded_horizon": size,
+                "cache_hit": cache_hit,
+                "compile_time": compile_time,
+                "solve_time": solve_time,
+                "total_time": total_time,
+                "status": problem.problem.status,
+            }
+        )
+        if problem.problem.status not in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+            raise ValueError(
+                f"Scheduling problem could not be solved. "
+                f"Status: {problem.problem.status}"
+            )
+        rates = np.maximum(problem.rates.value[:, :horizon], 0)
+        return {
+            station_id: rates[i, :]
+            for i, station_id in enumerate(infrastructure.station_ids)
+        }
@@ -0,0 +1,157 @@
+# coding=utf-8
+"""
+Lightweight wall-time instrumentation of experiment stages.
+"""
+import functools
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+# Shared context returned by disabled timers, so timing a stage costs one call.
+_NULL_STAGE = nullcontext()
+
+
+class _Stage:
+    """ Context manager timing one entry into a stage. """
+
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, self.start, time.perf_counter())
+
+
+class StageTimer:
+    """Wall time and call count of each named stage of an experiment.
+
+    When disabled, stage returns a shared no-op context manager, so instrumented
+    code pays only for a method call.
+
+    Args:
+        enabled (bool): If False, nothing is recorded.
+        trace (bool): If True, also keep every call (with its start time) so the
+            run can be exported as a trace file.
+
+    Example:
+        timer = StageTimer()
+        with timer.stage("solve"):
+            ...
+        timer.summary()
+    """
+
+    def __init__(self, enabled: bool = True, trace: bool = False):
+        self.enabled = enabled
+        self.trace = trace
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.events = []
+        self._origin = time.perf_counter()
+
+    @classmethod
+    def from_profile(cls, profile):
+        """Timer for the profile argument of an experiment: False (disabled), True
+        (totals only) or "trace" (totals and every call, for to_chrome_trace)."""
+        if profile not in (False, True, "trace"):
+            raise ValueError(f"Unknown profile mode {profile!r}.")
+        return cls(enabled=bool(profile), trace=profile == "trace")
+
+    def stage(self, name: str):
+        """ Context manager which times the enclosed block as stage name. """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name: str, start: float, end: float):
+        """ Record one call of stage name from start to end (perf_counter). """
+        self.totals[name] += end - start
+        self.counts[name] += 1
+        if self.trace:
+            self.events.append((name, start, end))
+
+    def wrap(self, function, name: str):
+        """ Return function, timed as stage name on every call. """
+        if not self.enabled:
+            return function
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, start, time.perf_counter())
+
+        return timed
+
+    @contextmanager
+    def patch(self, obj, method: str, name: str):
+        """Time every call of obj.method as stage name while the context is active.
+
+        The method is restored on exit, so obj can still be serialized or copied.
+        """
+        if not self.enabled:
+            yield
+            return
+        had_attribute = method in vars(obj)
+        original = getattr(obj, method)
+        setattr(obj, method, self.wrap(original, name))
+        try:
+            yield
+        finally:
+            if had_attribute:
+                setattr(obj, method, original)
+            else:
+                delattr(obj, method)
+
+    def reset(self):
+        """ Forget everything recorded so far. """
+        self.totals.clear()
+        self.counts.clear()
+        self.events.clear()
+        self._origin = time.perf_counter()
+
+    def summary(self) -> pd.DataFrame:
+        """pd.DataFrame: Calls, total and mean wall time [s] and share of the summed
+        time of each stage, sorted by total time. Time in nested stages also counts
+        toward the enclosing stage."""
+        df = pd.DataFrame(
+            {
+                "calls": pd.Series(self.counts, dtype=int),
+                "total": pd.Series(self.totals, dtype=float),
+            }
+        )
+        df["mean"] = df["total"] / df["calls"]
+        df["share"] = df["total"] / df["total"].sum()
+        return df.sort_values("total", ascending=False)
+
+    def to_chrome_trace(self, path: str):
+        """Write the recorded calls as a Chrome trace (chrome://tracing, Perfetto).
+
+        Requires trace=True, e.g. an experiment built with profile="trace".
+        """
+        if not self.trace:
+            raise ValueError("Calls are only kept when the timer has trace=True.")
+        pid = os.getpid()
+        events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (start - self._origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": 0,
+            }
+            for name, start, end in self.events
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
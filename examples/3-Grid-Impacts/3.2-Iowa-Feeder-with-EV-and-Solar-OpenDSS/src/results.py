@@ -0,0 +1,281 @@
+# coding=utf-8
+"""
+Fixed-size result storage for OpenDSS experiments.
+"""
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+# Families of detailed metrics which can be collected each step.
+METRIC_FAMILIES = ("summary", "overload", "capacity", "currents", "profile")
+
+# Columns of the feeder summary. Powers are in kW / kvar.
+SUMMARY_COLUMNS = (
+    "Total kW",
+    "Total kvar",
+    "Losses kW",
+    "Losses kvar",
+    "Line Losses kW",
+    "Line Losses kvar",
+    "Substation Losses kW",
+    "Substation Losses kvar",
+    "Max pu. voltage",
+    "Min pu. voltage",
+    "Iterations",
+    "Converged",
+)
+
+# Quantities stored per power delivery element for the capacity family.
+CAPACITY_QUANTITIES = ("Max Current", "%Normal", "%Emergency")
+
+
+class OpenDSSResults:
+    """Preallocated, columnar store for the per-step results of an OpenDSS run.
+
+    All arrays are sized once from the number of steps, nodes and regulators and
+    written in place, so memory and per-step cost do not grow with the horizon.
+    pandas views are only built when asked for and are cached until the next write.
+
+    Args:
+        times (pd.DatetimeIndex): Time of each step.
+        node_names (List[str]): Name of each node, in OpenDSS order.
+        regulator_names (List[str]): Name of each regulating transformer.
+        voltage_dtype (np.dtype): Floating point type used to store node voltages.
+
+    Attributes:
+        voltages (np.ndarray): Per unit voltage of each node. (steps x nodes)
+        taps (np.ndarray): Tap position of each regulator. (steps x regulators)
+        wdg (np.ndarray): Active winding of each regulator. (steps x regulators)
+        solved (np.ndarray): True for each step which has been stored. (steps,)
+        families (Set[str]): Detailed metric families allocated by allocate_metrics.
+    """
+
+    def __init__(
+        self,
+        times: pd.DatetimeIndex,
+        node_names: List[str],
+        regulator_names: List[str],
+        voltage_dtype=np.float64,
+    ):
+        self.times = times
+        self.node_names = list(node_names)
+        self.regulator_names = list(regulator_names)
+        steps = len(times)
+        self.voltages = np.full(
+            (steps, len(self.node_names)), np.nan, dtype=voltage_dtype
+        )
+        self.taps = np.full((steps, len(self.regulator_names)), np.nan)
+        self.wdg = np.zeros((steps, len(self.regulator_names)), dtype=np.int8)
+        self.solved = np.zeros(steps, dtype=bool)
+        self.families = set()
+        self._views = {}
+
+    @property
+    def steps(self):
+        """ int: Number of steps the store was sized for. """
+        return len(self.times)
+
+    def store_voltages(self, t, voltages):
+        """ Store per unit voltage of each node at step t. """
+        self.voltages[t] = voltages
+        self.solved[t] = True
+        self._views.clear()
+
+    def store_regulators(self, t, taps, wdg):
+        """ Store tap position and active winding of each regulator at step t. """
+        self.taps[t] = taps
+        self.wdg[t] = wdg
+        self._views.clear()
+
+    def allocate_metrics(
+        self,
+        families: Sequence[str],
+        element_names: Optional[List[str]] = None,
+        current_channels: Optional[List[str]] = None,
+        node_distances: Optional[np.ndarray] = None,
+    ):
+        """Allocate storage for the selected families of detailed metrics.
+
+        Args:
+            families (Sequence[str]): Subset of METRIC_FAMILIES to allocate.
+            element_names (List[str]): Power delivery elements, required for the
+                capacity and overload families.
+            current_channels (List[str]): Name of each conductor of each terminal of
+                each power delivery element, required for the currents family.
+            node_distances (np.ndarray): Distance of each node from the energy meter,
+                required for the profile family.
+        """
+        self.families = set(families)
+        unknown = self.families - set(METRIC_FAMILIES)
+        if unknown:
+            raise ValueError(f"Unknown metric families {sorted(unknown)}.")
+        steps = self.steps
+        if "summary" in self.families:
+            self.summary = np.full((steps, len(SUMMARY_COLUMNS)), np.nan)
+        if self.families & {"capacity", "overload"}:
+            self.element_names = list(element_names)
+            self.capacity = np.full(
+                (len(CAPACITY_QUANTITIES), steps, len(self.element_names)), np.nan
+            )
+        if "currents" in self.families:
+            self.current_channels = list(current_channels)
+            self.currents = np.full((steps, len(self.current_channels)), np.nan)
+        if "profile" in self.families:
+            self.node_distances = np.asarray(node_distances, dtype=float)
+        self._views.clear()
+
+    def store_metrics(self, t, summary=None, capacity=None, currents=None):
+        """Store the detailed metrics collected at step t.
+
+        Args:
+            t (int): Step index.
+            summary (Sequence[float]): One value per SUMMARY_COLUMNS.
+            capacity (Sequence[np.ndarray]): One array per CAPACITY_QUANTITIES, each
+                with one value per power delivery element.
+            currents (np.ndarray): Current magnitude of each channel.
+        """
+        if summary is not None:
+            self.summary[t] = summary
+        if capacity is not None:
+            for i, values in enumerate(capacity):
+                self.capacity[i, t] = values
+        if currents is not None:
+            self.currents[t] = currents
+        self._views.clear()
+
+    def row_keys(self):
+        """ Keys of the dictionaries returned by step_row. """
+        keys = {"voltages", "taps", "wdg"}
+        if "summary" in self.families:
+            keys.add("summary")
+        if self.families & {"capacity", "overload"}:
+            keys.add("capacity")
+        if "currents" in self.families:
+            keys.add("currents")
+        return keys
+
+    def step_row(self, t):
+        """ Copy of every result stored at step t, by array name. """
+        row = {
+            "voltages": self.voltages[t].copy(),
+            "taps": self.taps[t].copy(),
+            "wdg": self.wdg[t].copy(),
+        }
+        if "summary" in self.families:
+            row["summary"] = self.summary[t].copy()
+        if self.families & {"capacity", "overload"}:
+            row["capacity"] = self.capacity[:, t].copy()
+        if "currents" in self.families:
+            row["currents"] = self.currents[t].copy()
+        return row
+
+    def store_row(self, t, row):
+        """ Store the results of another step, as returned by step_row, at step t. """
+        self.voltages[t] = row["voltages"]
+        self.taps[t] = row["taps"]
+        self.wdg[t] = row["wdg"]
+        if "summary" in self.families:
+            self.summary[t] = row["summary"]
+        if self.families & {"capacity", "overload"}:
+            self.capacity[:, t] = row["capacity"]
+        if "currents" in self.families:
+            self.currents[t] = row["currents"]
+        self.solved[t] = True
+        self._views.clear()
+
+    def store_chunk(self, first, chunk, skip=0):
+        """Copy the results of a run over a subset of the steps into this store.
+
+        Args:
+            first (int): Step of this store matching the first step of chunk.
+            chunk (OpenDSSResults): Results of the subset run.
+            skip (int): Number of leading (warm-up) steps of chunk to discard.
+        """
+        if chunk.families and not self.families:
+            self.allocate_metrics(
+                chunk.families,
+                getattr(chunk, "element_names", None),
+                getattr(chunk, "current_channels", None),
+                getattr(chunk, "node_distances", None),
+            )
+        rows = slice(first + skip, first + chunk.steps)
+        self.voltages[rows] = chunk.voltages[skip:]
+        self.taps[rows] = chunk.taps[skip:]
+        self.wdg[rows] = chunk.wdg[skip:]
+        self.solved[rows] = chunk.solved[skip:]
+        if "summary" in chunk.families:
+            self.summary[rows] = chunk.summary[skip:]
+        if chunk.families & {"capacity", "overload"}:
+            self.capacity[:, rows] = chunk.capacity[:, skip:]
+        if "currents" in chunk.families:
+            self.currents[rows] = chunk.currents[skip:]
+        self._views.clear()
+
+    def summary_df(self):
+        """ pd.DataFrame: Feeder summary at each step (rows). """
+        if "summary" not in self._views:
+            self._views["summary"] = pd.DataFrame(
+                self.summary[self.solved],
+                index=self.times[self.solved],
+                columns=SUMMARY_COLUMNS,
+            )
+        return self._views["summary"]
+
+    def capacity_df(self, quantity="%Normal"):
+        """ pd.DataFrame: One of CAPACITY_QUANTITIES per element (rows) and step. """
+        values = self.capacity[CAPACITY_QUANTITIES.index(quantity)]
+        return self._view(f"capacity {quantity}", values, self.element_names)
+
+    def overload_df(self, limit=100):
+        """pd.DataFrame: Elements loaded above limit percent of their normal rating.
+
+        One row per overloaded element and step, indexed by element name, mirroring
+        the OpenDSS overload report.
+        """
+        key = f"overload {limit}"
+        if key not in self._views:
+            steps, elements = np.nonzero(self.capacity[1] > limit)
+            self._views[key] = pd.DataFrame(
+                {
+                    "Time": self.times[steps],
+                    **{
+                        quantity: self.capacity[i, steps, elements]
+                        for i, quantity in enumerate(CAPACITY_QUANTITIES)
+                    },
+                },
+                index=pd.Index(np.array(self.element_names)[elements], name="Element"),
+            )
+        return self._views[key]
+
+    def currents_df(self):
+        """ pd.DataFrame: Current magnitude of each channel (rows) at each step. """
+        return self._view("currents", self.currents, self.current_channels)
+
+    def profile_df(self):
+        """ pd.DataFrame: Distance and per unit voltage of each node at each step. """
+        if "profile" not in self._views:
+            df = self.voltage_pu().copy()
+            df.insert(0, "Distance", self.node_distances)
+            self._views["profile"] = df
+        return self._views["profile"]
+
+    def _view(self, key, values, index):
+        """ Cached DataFrame of values (steps x columns) for the stored steps. """
+        if key not in self._views:
+            self._views[key] = pd.DataFrame(
+                values[self.solved].T, index=index, columns=self.times[self.solved]
+            )
+        return self._views[key]
+
+    def voltage_pu(self):
+        """ pd.DataFrame: Per unit voltage of each node (rows) at each step. """
+        return self._view("voltage_pu", self.voltages, self.node_names)
+
+    def tap_df(self):
+        """ pd.DataFrame: Tap position of each regulator (rows) at each step. """
+        return self._view("taps", self.taps, self.regulator_names)
+
+    def wdg_df(self):
+        """ pd.DataFrame: Active winding of each regulator (rows) at each step. """
+        return self._view("wdg", self.wdg, self.regulator_names)
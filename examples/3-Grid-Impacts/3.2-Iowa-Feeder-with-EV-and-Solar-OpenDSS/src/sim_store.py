@@ -0,0 +1,172 @@
+# coding=utf-8
+"""
+Compact array storage for ACN-Sim simulation results.
+"""
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+from acnportal import acnsim
+
+# noinspection PyUnresolvedReferences
+from constraint_model import CompiledConstraints
+
+METADATA_FILE = "metadata.json"
+NETWORK_FILE = "network.npz"
+RATES_FILE = "charging_rates.npy"
+COMPRESSED_RATES_FILE = "charging_rates.npz"
+
+
+class SimulationArrays:
+    """The arrays of a finished simulation needed for downstream analysis.
+
+    Stores the charging-rate matrix together with the network description needed
+    to recover aggregate power and constraint currents, without the events, EVs
+    and scheduler state of a full Simulator.
+
+    Args:
+        charging_rates (np.ndarray): Charging rate of each station. (stations x T) [A]
+        station_ids (List[str]): Station id of each row of charging_rates.
+        voltages (np.ndarray): Voltage of each station. [V]
+        phase_angles (np.ndarray): Phase angle of each station. [degrees]
+        constraint_matrix (np.ndarray): Coefficients of each constraint.
+            (constraints x stations)
+        constraint_ids (List[str]): Name of each constraint.
+        metadata (Dict): JSON-serializable information about the simulation.
+    """
+
+    def __init__(
+        self,
+        charging_rates: np.ndarray,
+        station_ids: List[str],
+        voltages: np.ndarray,
+        phase_angles: np.ndarray,
+        constraint_matrix: np.ndarray,
+        constraint_ids: List[str],
+        metadata: Optional[Dict] = None,
+    ):
+        self.charging_rates = charging_rates
+        self.station_ids = list(station_ids)
+        self.voltages = np.asarray(voltages)
+        self.phase_angles = np.asarray(phase_angles)
+        self.constraint_matrix = np.asarray(constraint_matrix)
+        self.constraint_ids = list(constraint_ids)
+        self.metadata = metadata if metadata is not None else {}
+        self._constraints = None
+
+    @classmethod
+    def from_simulator(cls, sim: acnsim.Simulator, metadata: Optional[Dict] = None):
+        """ Extract the arrays of a finished Simulator. """
+        network = sim.network
+        metadata = dict(metadata or {})
+        metadata.setdefault("start", sim.start.isoformat())
+        metadata.setdefault("period", sim.period)
+        return cls(
+            np.asarray(sim.charging_rates),
+            network.station_ids,
+            network.voltages,
+            network.phase_angles,
+            network.constraint_matrix,
+            network.constraint_index,
+            metadata,
+        )
+
+    def aggregate_power(self):
+        """ Aggregate power of all stations at each step. [kW] """
+        return self.voltages @ self.charging_rates / 1000
+
+    @property
+    def constraints(self) -> CompiledConstraints:
+        """ CompiledConstraints: The network's constraints, compiled on first use. """
+        if self._constraints is None:
+            self._constraints = CompiledConstraints(
+                self.constraint_matrix,
+                self.constraint_ids,
+                self.phase_angles,
+                self.station_ids,
+            )
+        return self._constraints
+
+    def constraint_currents(self, return_magnitudes=False, constraint_ids=None):
+        """Current through each constraint at each step.
+
+        Matches acnsim.constraint_currents for the stored simulation.
+
+        Args:
+            return_magnitudes (bool): If True, return magnitudes instead of phasors.
+            constraint_ids (List[str]): Constraints to include. Defaults to all.
+
+        Returns:
+            Dict[str, np.ndarray]: Current through each constraint. [A]
+        """
+        return self.constraints.constraint_currents(
+            self.charging_rates, return_magnitudes, constraint_ids
+        )
+
+    def save(self, path: str, compress: bool = False):
+        """Write the arrays to the directory at path.
+
+        Args:
+            path (str): Directory to write to. Created if needed.
+            compress (bool): If True, store the charging rates compressed. This
+                saves space but the rates can then no longer be memory-mapped.
+        """
+        os.makedirs(path, exist_ok=True)
+        if compress:
+            np.savez_compressed(
+                os.path.join(path, COMPRESSED_RATES_FILE),
+                charging_rates=self.charging_rates,
+            )
+        else:
+            np.save(os.path.join(path, RATES_FILE), self.charging_rates)
+        np.savez(
+            os.path.join(path, NETWORK_FILE),
+            voltages=self.voltages,
+            phase_angles=self.phase_angles,
+            constraint_matrix=self.constraint_matrix,
+        )
+        with open(os.path.join(path, METADATA_FILE), "w") as f:
+            json.dump(
+                {
+                    "station_ids": self.station_ids,
+                    "constraint_ids": self.constraint_ids,
+                    "shape": list(self.charging_rates.shape),
+                    "dtype": str(self.charging_rates.dtype),
+                    "metadata": self.metadata,
+                },
+                f,
+            )
+
+    @staticmethod
+    def read_metadata(path: str) -> Dict:
+        """ Read only the metadata header of the arrays stored at path. """
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            return json.load(f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        """Read arrays written by save.
+
+        Args:
+            path (str): Directory written by save.
+            mmap (bool): If True, memory-map uncompressed charging rates so only the
+                parts which are used are read from disk.
+        """
+        header = cls.read_metadata(path)
+        rates_path = os.path.join(path, RATES_FILE)
+        if os.path.exists(rates_path):
+            charging_rates = np.load(rates_path, mmap_mode="r" if mmap else None)
+        else:
+            with np.load(os.path.join(path, COMPRESSED_RATES_FILE)) as f:
+                charging_rates = f["charging_rates"]
+        with np.load(os.path.join(path, NETWORK_FILE)) as network:
+            return cls(
+                charging_rates,
+                header["station_ids"],
+                network["voltages"],
+                network["phase_angles"],
+                network["constraint_matrix"],
+                header["constraint_ids"],
+                header["metadata"],
+            )
@@ -0,0 +1,184 @@
+# coding=utf-8
+"""
+In-memory cache of OpenDSS step solutions keyed by load and regulator state.
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Iterable, NamedTuple, Optional
+
+import numpy as np
+
+# Resolution at which regulator taps are compared. [pu]
+TAP_RESOLUTION = 1e-6
+
+
+class LoadState(NamedTuple):
+    """ Circuit, loads and pre-solve regulator taps of one step, with their digest. """
+
+    key: bytes
+    circuit: bytes
+    kw: np.ndarray
+    kvar: np.ndarray
+    taps: np.ndarray
+
+
+class SolutionCache:
+    """Bounded LRU cache of the results of solved steps.
+
+    Steps are keyed by a digest of the circuit they were solved on, of their kW and
+    kvar, quantized to resolution, and of the regulator taps before the solve, so a
+    step whose circuit, loads and taps match an earlier one reuses its stored
+    results instead of being solved again. Loads in the same bucket differ by less
+    than resolution, which bounds the load error of a hit. Including the circuit
+    lets one cache be shared by experiments on different circuits.
+
+    With a tolerance, a step whose loads are all within tolerance of the last
+    solved step (and whose circuit and taps match) also reuses that step's
+    results. The load change is measured from the last solve, not the last reused
+    step, so errors do not accumulate.
+
+    The voltage error this introduces is estimated from the largest change in node
+    voltage per kW of load change seen between consecutive solves, so it is a
+    first-order estimate rather than a guarantee.
+
+    Args:
+        max_entries (int): Largest number of steps kept. The least recently used
+            step is evicted first.
+        resolution (float): Quantization of loads in the digest. [kW or kvar]
+        tolerance (float): If given, largest load change since the last solve at
+            which a step is skipped. [kW or kvar]
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        resolution: float = 1e-3,
+        tolerance: Optional[float] = None,
+    ):
+        self.max_entries = max_entries
+        self.resolution = resolution
+        self.tolerance = tolerance
+        self._entries = OrderedDict()
+        self._last = None
+        self.clear_stats()
+
+    def clear_stats(self):
+        """ Reset the statistics reported by stats. """
+        self.lookups = 0
+        self.hits = 0
+        self.skips = 0
+        self.evictions = 0
+        self.skip_error = 0.0
+        self.sensitivity = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def state(self, kw, kvar, taps, circuit: bytes = b"") -> LoadState:
+        """Digest of the loads and pre-solve taps of a step.
+
+        Args:
+            kw (np.ndarray): kW of each load.
+            kvar (np.ndarray): kvar of each load.
+            taps (np.ndarray): Tap of each regulator winding before the solve.
+            circuit (bytes): Identity of the circuit, e.g.
+                OpenDSSExperiment.circuit_key.
+        """
+        h = hashlib.blake2b(circuit, digest_size=16)
+        for values, resolution in (
+            (kw, self.resolution),
+            (kvar, self.resolution),
+            (taps, TAP_RESOLUTION),
+        ):
+            h.update(np.round(np.asarray(values) / resolution).astype(np.int64))
+        return LoadState(
+            h.digest(), circuit, np.array(kw), np.array(kvar), np.array(taps)
+        )
+
+    def start(self):
+        """ Forget the last solve, e.g. because the circuit was rebuilt. """
+        self._last = None
+
+    def lookup(self, state: LoadState, keys: Iterable[str]) -> Optional[Dict]:
+        """Stored results of a step matching state, or None.
+
+        Args:
+            state (LoadState): State of the step, from state.
+            keys (Iterable[str]): Results the step needs (see
+                OpenDSSResults.row_keys). Entries missing any are not used.
+
+        Returns:
+            Dict[str, np.ndarray]: Results of the matching step, as stored.
+        """
+        keys = set(keys)
+        self.lookups += 1
+        row = self._entries.get(state.key)
+        if row is not None and keys <= row.keys():
+            self._entries.move_to_end(state.key)
+            self.hits += 1
+            return row
+        if self.tolerance is None or self._last is None:
+            return None
+        last, row = self._last
+        if not keys <= row.keys() or not _same_circuit(last, state):
+            return None
+        change = _load_change(last, state)
+        if change > self.tolerance:
+            return None
+        self.skips += 1
+        self.skip_error = max(self.skip_error, change)
+        return row
+
+    def store(self, state: LoadState, row: Dict):
+        """ Store the results of a solved step. """
+        if self._last is not None:
+            last, last_row = self._last
+            change = _same_circuit(last, state) and _load_change(last, state)
+            if change > 0:
+                dv = np.nanmax(np.abs(row["voltages"] - last_row["voltages"]))
+                self.sensitivity = max(self.sensitivity, dv / change)
+        self._last = (state, row)
+        self._entries[state.key] = row
+        self._entries.move_to_end(state.key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """ Drop every entry and reset the statistics. """
+        self._entries.clear()
+        self._last = None
+        self.clear_stats()
+
+    def stats(self) -> Dict[str, float]:
+        """Hit rate and error bounds of the lookups so far.
+
+        Returns:
+            Dict[str, float]: lookups, hits (digest matches), skips (within
+                tolerance), solves, hit_rate (share of lookups answered without a
+                solve), entries, evictions, load_error (largest load difference
+                of a reused step) [kW or kvar] and voltage_error (first-order
+                estimate of the largest resulting voltage error) [pu].
+        """
+        load_error = max(self.resolution if self.hits else 0.0, self.skip_error)
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "skips": self.skips,
+            "solves": self.lookups - self.hits - self.skips,
+            "hit_rate": (self.hits + self.skips) / self.lookups if self.lookups else 0,
+            "entries": len(self._entries),
+            "evictions": self.evictions,
+            "load_error": load_error,
+            "voltage_error": self.sensitivity * load_error,
+        }
+
+
+def _same_circuit(a: LoadState, b: LoadState) -> bool:
+    """ True if two states share the circuit and pre-solve taps. """
+    return a.circuit == b.circuit and np.array_equal(a.taps, b.taps)
+
+
+def _load_change(a: LoadState, b: LoadState) -> float:
+    """ Largest change in kW or kvar of any load between two states. """
+    return float(max(np.abs(a.kw - b.kw).max(), np.abs(a.kvar - b.kvar).max()))
@@ -0,0 +1,159 @@
+# coding=utf-8
+"""
+Run sweeps of independent ACN-Sim experiments on a process pool.
+"""
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from tqdm import tqdm
+
+# noinspection PyUnresolvedReferences
+from acn_experiment import ACNExperiment
+
+# Environment variables which limit the threads used by BLAS / OpenMP backends.
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+)
+
+
+@contextmanager
+def thread_limits(threads: int):
+    """Temporarily cap BLAS / OpenMP threads in this process' environment.
+
+    Worker processes started while the context is active inherit the limits,
+    which must be in place before they import numpy.
+    """
+    previous = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def capped_config(config: Dict, threads: int) -> Dict:
+    """Copy of an ACNExperiment config whose MOSEK solves use at most threads.
+
+    The cap is passed as a MOSEK solver option, which only the parameterized
+    algorithms accept; other algorithms are only capped through the BLAS / OpenMP
+    limits of thread_limits. Options already in the config take precedence.
+    """
+    options = dict(config.get("solver_options") or {})
+    mosek = dict(options.get("MOSEK") or {})
+    params = dict(mosek.get("mosek_params") or {})
+    params.setdefault("MSK_IPAR_NUM_THREADS", threads)
+    mosek["mosek_params"] = params
+    options["MOSEK"] = mosek
+    return {**config, "solver_options": options}
+
+
+def _run_config(config: Dict):
+    """ Run a single experiment in a worker process. """
+    experiment = ACNExperiment(**config)
+    experiment.run()
+    return experiment.sim_filename()
+
+
+def run_sweep(
+    configs: List[Dict],
+    workers: Optional[int] = None,
+    solver_threads: Optional[int] = None,
+) -> List[Dict]:
+    """Run ACNExperiments for a list of configurations in parallel.
+
+    Configurations which are already in the simulation cache are skipped. Failures
+    are caught per configuration, so one bad configuration does not stop the sweep.
+
+    Args:
+        configs (List[Dict]): Keyword arguments for each ACNExperiment.
+        workers (int): Number of worker processes. Defaults to the number of cores.
+        solver_threads (int): Threads each worker may use for BLAS and the solver
+            (see capped_config). Defaults to cores // workers (at least 1), so the
+            workers do not oversubscribe the machine.
+
+    Returns:
+        List[Dict]: One record per configuration (in input order) with keys
+            "config", "status" ("skipped", "done" or "failed"), "filename" and
+            "error".
+    """
+    cores = os.cpu_count() or 1
+    workers = workers or cores
+    if solver_threads is None:
+        solver_threads = max(1, cores // workers)
+
+    results = []
+    pending = []
+    for i, config in enumerate(configs):
+        experiment = ACNExperiment(**config)
+        filename = experiment.sim_filename()
+        skipped = experiment.cache.lookup(experiment.cache_key()) is not None
+        results.append(
+            {
+                "config": config,
+                "status": "skipped" if skipped else None,
+                "filename": filename,
+                "error": None,
+            }
+        )
+        if not skipped:
+            pending.append((i, experiment))
+
+    # Fetch each event window once, here, rather than racing to write it from
+    # several workers.
+    fetch_errors = {}
+    for _, experiment in pending:
+        events_filename = experiment.events_filename()
+        if events_filename not in fetch_errors:
+            try:
+                experiment.get_events()
+                fetch_errors[events_filename] = None
+            except Exception:
+                fetch_errors[events_filename] = traceback.format_exc()
+    runnable = []
+    for i, experiment in pending:
+        error = fetch_errors[experiment.events_filename()]
+        if error is None:
+            runnable.append((i, experiment))
+        else:
+            results[i]["status"] = "failed"
+            results[i]["error"] = error
+
+    # Spawn rather than fork, so workers start with a fresh BLAS thread pool.
+    context = multiprocessing.get_context("spawn")
+    with thread_limits(solver_threads), ProcessPoolExecutor(
+        max_workers=workers, mp_context=context
+    ) as pool:
+        futures = {
+            pool.submit(_run_config, capped_config(configs[i], solver_threads)): i
+            for i, _ in runnable
+        }
+        progress = tqdm(
+            as_completed(futures),
+            total=len(configs),
+            initial=len(configs) - len(runnable),
+        )
+        for future in progress:
+            record = results[futures[future]]
+            try:
+                future.result()
+                record["status"] = "done"
+            except Exception:
+                record["status"] = "failed"
+                record["error"] = traceback.format_exc()
+            progress.set_postfix(
+                failed=sum(r["status"] == "failed" for r in results),
+                skipped=len(configs) - len(pending),
+            )
+    return results